@@ -37,6 +37,12 @@ MONGODB_DB = (
     or "kleinanzeigen"
 )
 
+# Mongo connection pool (one client per process, shared by every UserManager)
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "50"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "5"))
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "60000"))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "2000"))
+
 # Telegram: prefer MINIAPP_* to avoid clashing with existing bot
 TELEGRAM_BOT_TOKEN = (
     os.getenv("MINIAPP_TELEGRAM_BOT_TOKEN")
@@ -51,6 +57,13 @@ TELEGRAM_FALLBACK_CHAT_ID = (
     or os.getenv("TELEGRAM_CHAT_ID", "")
 )
 
+# Bot API HTTP pool: broadcasts and the worker pool send concurrently, so a request waits
+# up to TELEGRAM_POOL_TIMEOUT for a free connection instead of failing after PTB's 1s default
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.getenv("TELEGRAM_CONNECTION_POOL_SIZE", "256"))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", "10"))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "10"))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "20"))
+
 NOTIFY_INTERVAL_MINUTES = int(os.getenv("NOTIFY_INTERVAL_MINUTES", "30"))
 SCHED_START_HOUR = int(os.getenv("SCHED_START_HOUR", "6"))
 SCHED_END_HOUR = int(os.getenv("SCHED_END_HOUR", "23"))
@@ -1,16 +1,35 @@
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING
 from pymongo.errors import OperationFailure
-from .config import MONGODB_URI, MONGODB_DB
+from .config import (
+    MONGODB_URI,
+    MONGODB_DB,
+    MONGODB_MAX_POOL_SIZE,
+    MONGODB_MIN_POOL_SIZE,
+    MONGODB_MAX_IDLE_TIME_MS,
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+)
 
 _client = None
 _db = None
 
 
+def get_client() -> MongoClient:
+    global _client
+    if _client is None:
+        _client = MongoClient(
+            MONGODB_URI,
+            maxPoolSize=MONGODB_MAX_POOL_SIZE,
+            minPoolSize=MONGODB_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+            serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        )
+    return _client
+
+
 def get_db():
-    global _client, _db
+    global _db
     if _db is None:
-        _client = MongoClient(MONGODB_URI)
-        _db = _client[MONGODB_DB]
+        _db = get_client()[MONGODB_DB]
         try:
             ensure_indexes(_db)
         except Exception:
@@ -55,6 +74,33 @@ def ensure_indexes(db):
         _ensure_unique_index(db.listings, [("hash", ASCENDING)], name="hash_1")
     except Exception:
         pass
+    # Case-insensitive username search (older documents are backfilled by scripts/migrate_db.py)
+    try:
+        db.users.create_index([("username_lower", ASCENDING)], name="username_lower_1")
+    except Exception:
+        pass
+    # Admin user list (role $ne "admin", newest first): a role prefix would split into two
+    # ranges and lose date order, so walk date_added and filter out the few admins
+    try:
+        db.users.create_index([("date_added", DESCENDING)], name="date_added_-1")
+    except Exception:
+        pass
+    # Active-user scans and the admin cancel-subscription picker; the trailing label fields
+    # let the picker (projection user_id/username/first_name, no _id) be served from the index alone
+    try:
+        db.users.create_index([
+            ("status", ASCENDING), ("subscription_expires", ASCENDING),
+            ("user_id", ASCENDING), ("username", ASCENDING), ("first_name", ASCENDING),
+        ], name="status_subexp_label_cover")
+    except Exception:
+        pass
+    # Broadcast sweep (status/blocked filter, user_id-only projection) is covered by this narrow index
+    try:
+        db.users.create_index(
+            [("status", ASCENDING), ("blocked", ASCENDING), ("user_id", ASCENDING)], name="status_blocked_user_id"
+        )
+    except Exception:
+        pass
     # Compound unique for recipient+listing notifications
     try:
         db.notification_stats.create_index([
@@ -67,3 +113,11 @@ def ensure_indexes(db):
             ], name="recipient_listing_nonuniq")
         except Exception:
             pass
+    # recipient_id-only lookups/deletes (clear_user, delete_user) are served by the
+    # prefix of the index above; the daily-limit count also filters by date + type
+    try:
+        db.notification_stats.create_index([
+            ("recipient_id", ASCENDING), ("date", ASCENDING), ("notification_type", ASCENDING)
+        ], name="recipient_date_type")
+    except Exception:
+        pass
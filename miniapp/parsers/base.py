@@ -3,9 +3,29 @@ from dataclasses import dataclass
 from datetime import datetime
 from typing import List, Dict, Any
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 from ..config import DEFAULT_HEADERS
 
+_session = None
+
+
+def get_session() -> requests.Session:
+    """Process-wide HTTP session so all parsers reuse pooled keep-alive connections."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        _session.headers.update(DEFAULT_HEADERS)
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(total=3, backoff_factor=0.3),
+        )
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
 @dataclass
 class Listing:
     listing_id: str
@@ -24,13 +44,24 @@ class BaseParser:
     source = "base"
 
     def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update(DEFAULT_HEADERS)
+        self.session = get_session()
+        # Response behind the most recent get(); diagnostics only (not meaningful
+        # when one parser instance is shared across runner threads)
+        self.last_response: requests.Response | None = None
 
     def get(self, url: str) -> BeautifulSoup:
+        r = self.fetch(url)
+        self.last_response = r
+        return BeautifulSoup(r.text, "html.parser")
+
+    def fetch(self, url: str) -> requests.Response:
         r = self.session.get(url, timeout=20)
         r.raise_for_status()
-        return BeautifulSoup(r.text, "html.parser")
+        return r
+
+    def get_bytes(self, url: str) -> bytes:
+        """Raw response body, for callers that can scan bytes without building a DOM."""
+        return self.fetch(url).content
 
     def hash_listing(self, title: str, price: int, location: str) -> str:
         base = f"{title}|{price}|{location}|{self.source}"
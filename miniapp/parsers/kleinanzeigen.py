@@ -1,14 +1,31 @@
 from typing import List
 from bs4 import BeautifulSoup
+import soupsieve as sv
 from .base import BaseParser, Listing
 from datetime import datetime
 
+# Selectors are compiled once at import instead of on every card
+CARD_SEL = sv.compile("article.aditem")
+TITLE_SELS = (
+    sv.compile("h2 a.ellipsis"),
+    sv.compile("a.ellipsis"),
+    sv.compile('h2 a[href*="/s-anzeige/"]'),
+)
+PRICE_SELS = (
+    sv.compile(".aditem-main--middle--price-shipping .aditem-main--middle--price"),
+    sv.compile(".aditem-main--middle--price"),
+    sv.compile(".aditem-details--top--price"),
+    sv.compile(".aditem-main--top--price"),
+)
+LOCATION_SEL = sv.compile(".aditem-main--top--left")
+
+
 class KleinanzeigenParser(BaseParser):
     source = "kleinanzeigen"
 
     def parse(self, url: str) -> List[Listing]:
         soup = self.get(url)
-        cards = soup.select("article.aditem")
+        cards = CARD_SEL.select(soup)
         out: List[Listing] = []
         for c in cards:
             # Filter by Heute only (classes vary; search in bottom row text)
@@ -22,9 +39,7 @@ class KleinanzeigenParser(BaseParser):
             card_text = c.get_text(" ", strip=True)
             # Prefer the title anchor under h2 with class 'ellipsis'
             title_el = (
-                c.select_one("h2 a.ellipsis")
-                or c.select_one("a.ellipsis")
-                or c.select_one('h2 a[href*="/s-anzeige/"]')
+                next((el for el in (sel.select_one(c) for sel in TITLE_SELS) if el), None)
                 or c.find('a', href=True)
             )
             if not title_el:
@@ -33,12 +48,7 @@ class KleinanzeigenParser(BaseParser):
             link = title_el.get("href") or ""
             if link and link.startswith("/"):
                 link = f"https://www.kleinanzeigen.de{link}"
-            price_el = (
-                c.select_one(".aditem-main--middle--price-shipping .aditem-main--middle--price")
-                or c.select_one(".aditem-main--middle--price")
-                or c.select_one(".aditem-details--top--price")
-                or c.select_one(".aditem-main--top--price")
-            )
+            price_el = next((el for el in (sel.select_one(c) for sel in PRICE_SELS) if el), None)
             price = 0
             price_text = price_el.get_text(strip=True) if price_el else ""
             if price_text:
@@ -57,7 +67,7 @@ class KleinanzeigenParser(BaseParser):
                         price = int(m.group(1).replace('.', ''))
                     except Exception:
                         price = 0
-            loc_el = c.select_one(".aditem-main--top--left")
+            loc_el = LOCATION_SEL.select_one(c)
             location = loc_el.get_text(strip=True) if loc_el else ""
             # Try to parse size (m²) and rooms from card text
             import re as _re
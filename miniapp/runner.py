@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 import pytz
 import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from telegram.ext import Application
 from .config import (
     NOTIFY_INTERVAL_MINUTES,
@@ -35,6 +36,8 @@ logging.basicConfig(
 
 um = UserManager()
 application: Application | None = None
+# Parsers do blocking HTTP; run them off the event loop and overlap per-URL fetches
+_parse_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="parse")
 
 def berlin_now():
     tz = pytz.timezone('Europe/Berlin')
@@ -137,6 +140,30 @@ def _format_admin_notification(user_id: str, user_data: Dict, per_url_stats: Dic
     return "\n".join(lines)
 
 
+async def _prefetch_listings(urls: List[str], parsers_map: Dict[str, object], parsed_cache: Dict[str, list]):
+    """Parse all not-yet-cached URLs concurrently and store results in parsed_cache."""
+    todo = []
+    for url in dict.fromkeys(urls):
+        if url in parsed_cache:
+            continue
+        domain = "" if "//" not in url else url.split("//", 1)[1].split("/", 1)[0]
+        parser = next((p for d, p in parsers_map.items() if d in domain), None)
+        if parser:
+            todo.append((url, parser))
+    if not todo:
+        return
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        *(loop.run_in_executor(_parse_pool, parser.parse, url) for url, parser in todo),
+        return_exceptions=True,
+    )
+    for (url, _), res in zip(todo, results):
+        if isinstance(res, BaseException):
+            logger.warning("Parsing %s failed: %r", url, res)
+            res = []
+        parsed_cache[url] = res
+
+
 async def send_message(chat_id: str, text: str) -> bool:
     if not application:
         return False
@@ -162,7 +189,8 @@ async def send_message(chat_id: str, text: str) -> bool:
             out_lines.pop()
         return "\n".join(out_lines)
     try:
-        await application.bot.send_message(chat_id=chat_id, text=normalize_text(text), disable_web_page_preview=True)
+        # Link previews are disabled via the application's Defaults
+        await application.bot.send_message(chat_id=chat_id, text=normalize_text(text))
         return True
     except Exception:
         return False
@@ -246,25 +274,14 @@ async def async_run_for_user(user_id: str, ignore_window: bool = True):
     }
 
     parsed_cache: dict[str, list] = {}
+    await _prefetch_listings(urls, parsers_map, parsed_cache)
     new_found = 0
     per_url_stats: Dict[str, Dict[str, int]] = {}
     for url in urls:
-        domain = "" if "//" not in url else url.split("//", 1)[1].split("/", 1)[0]
-        parser = None
-        for d, p in parsers_map.items():
-            if d in domain:
-                parser = p
-                break
-        if not parser:
+        # Prefetch parsed every URL that has a parser; the rest are skipped
+        listings = parsed_cache.get(url)
+        if listings is None:
             continue
-        if url in parsed_cache:
-            listings = parsed_cache[url]
-        else:
-            try:
-                listings = parser.parse(url)
-            except Exception:
-                listings = []
-            parsed_cache[url] = listings
         per_url_stats[url] = {"parsed": len(listings), "filtered": 0, "dedup": 0, "limit": 0, "sent": 0}
         for lst in listings:
             if not match_location(lst.location, preferred):
@@ -349,25 +366,14 @@ async def _async_process_user(u: Dict, parsers_map: Dict[str, object], parsed_ca
         return
     if not urls:
         return
+    await _prefetch_listings(urls, parsers_map, parsed_cache)
     per_url_stats: Dict[str, Dict[str, int]] = {}
     new_found = 0
     for url in urls:
-        domain = "" if "//" not in url else url.split("//", 1)[1].split("/", 1)[0]
-        parser = None
-        for d, p in parsers_map.items():
-            if d in domain:
-                parser = p
-                break
-        if not parser:
+        # Prefetch parsed every URL that has a parser; the rest are skipped
+        listings = parsed_cache.get(url)
+        if listings is None:
             continue
-        if url in parsed_cache:
-            listings = parsed_cache[url]
-        else:
-            try:
-                listings = parser.parse(url)
-            except Exception:
-                listings = []
-            parsed_cache[url] = listings
         per_url_stats[url] = {"parsed": len(listings), "filtered": 0, "dedup": 0, "limit": 0, "sent": 0}
         for lst in listings:
             # Persist listing once for global dedup across users
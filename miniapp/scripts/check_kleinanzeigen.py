@@ -1,10 +1,10 @@
 import argparse
 from typing import List
-from miniapp.parsers.kleinanzeigen import KleinanzeigenParser
-from miniapp.user_manager import UserManager
 
 
 def load_urls_for_user(user_id: str) -> List[str]:
+    from miniapp.user_manager import UserManager
+
     um = UserManager()
     f = um.get_user_filters(user_id) or {}
     urls = f.get("search_urls", [])
@@ -26,6 +26,8 @@ def main():
         print("Provide --user <id> or explicit URLs")
         return
 
+    from miniapp.parsers.kleinanzeigen import KleinanzeigenParser
+
     kp = KleinanzeigenParser()
     for u in urls:
         print("\nURL:", u)
@@ -1,6 +1,5 @@
 import argparse
 import os
-from pymongo import MongoClient
 
 
 def connect_db():
@@ -12,6 +11,8 @@ def connect_db():
         or "mongodb://localhost:27017"
     )
     db_name = os.getenv("MONGO_DB_NAME", "kleinanzeigen")
+    from pymongo import MongoClient
+
     client = MongoClient(uri)
     return client[db_name]
 
@@ -38,6 +39,9 @@ def main():
     )
 
     args = parser.parse_args()
+    # Non-interactive confirmation for scripted/CI runs
+    if os.getenv("MINIAPP_CONFIRM_CLEAR", "").strip().lower() == "yes":
+        args.yes = True
 
     default_cols = [
         "users",
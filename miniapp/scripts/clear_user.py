@@ -1,14 +1,33 @@
 import argparse
-from miniapp.user_manager import UserManager
 
 
 def main():
     ap = argparse.ArgumentParser(description="Clear per-user notification stats")
     ap.add_argument("user_id")
+    ap.add_argument(
+        "--batch-size",
+        type=int,
+        default=0,
+        help="Delete in chunks of N documents with progress output (default: single delete_many)",
+    )
     args = ap.parse_args()
+    from miniapp.user_manager import UserManager
+
     um = UserManager()
-    res = um.db.notification_stats.delete_many({"recipient_id": str(args.user_id)})
-    print(f"Deleted notifications: {res.deleted_count}")
+    criteria = {"recipient_id": str(args.user_id)}
+    if args.batch_size <= 0:
+        res = um.db.notification_stats.delete_many(criteria)
+        print(f"Deleted notifications: {res.deleted_count}")
+        return
+    total = 0
+    while True:
+        ids = [d["_id"] for d in um.db.notification_stats.find(criteria, {"_id": 1}).limit(args.batch_size)]
+        if not ids:
+            break
+        res = um.db.notification_stats.delete_many({"_id": {"$in": ids}})
+        total += res.deleted_count
+        print(f"Deleted {res.deleted_count} (total {total})")
+    print(f"Deleted notifications: {total}")
 
 
 if __name__ == "__main__":
@@ -1,18 +1,16 @@
 import argparse
-import sys
-from bs4 import BeautifulSoup
-from miniapp.parsers.base import BaseParser
 
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("url")
     args = ap.parse_args()
+    from miniapp.parsers.base import BaseParser
+
     bp = BaseParser()
     soup = bp.get(args.url)
-    html = soup.prettify()
-    print("HTML length:", len(html))
-    cards = soup.select("article.aditem")
+    print("HTML length:", len(bp.last_response.content))
+    cards = soup.find_all("article", class_="aditem")
     print("cards:", len(cards))
     for i, c in enumerate(cards[:3]):
         t = c.get_text(" ", strip=True)
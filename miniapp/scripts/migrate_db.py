@@ -0,0 +1,45 @@
+import argparse
+
+# Indexes that ensure_indexes no longer creates; dropped from existing databases
+OBSOLETE_INDEXES = {
+    "users": [
+        # role $ne "admin" can't use it for date order; date_added_-1 serves the admin list
+        "role_date_added",
+        # Old 2-field (status, subscription_expires) index; the covering 5-field version is
+        # status_subexp_label_cover (reusing the name made create_index fail on old databases)
+        "status_subscription_expires",
+    ],
+}
+
+
+def drop_obsolete_indexes(db):
+    for coll, names in OBSOLETE_INDEXES.items():
+        existing = db[coll].index_information()
+        for name in names:
+            if name in existing:
+                db[coll].drop_index(name)
+                print(f"{coll}: dropped index {name}")
+
+
+def backfill_username_lower(db):
+    """username_lower for documents created before the field existed."""
+    res = db.users.update_many(
+        {"username_lower": {"$exists": False}, "username": {"$type": "string"}},
+        [{"$set": {"username_lower": {"$toLower": "$username"}}}],
+    )
+    print(f"users: backfilled username_lower on {res.modified_count}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="One-off MongoDB migrations for the mini app (safe to re-run)")
+    ap.parse_args()
+    from miniapp.db import get_db
+
+    db = get_db()
+    drop_obsolete_indexes(db)
+    backfill_username_lower(db)
+    print("Migration done")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 import argparse
-from miniapp.user_manager import UserManager
+import re
+from datetime import datetime
+
+KLEIN_RE = re.compile(r"kleinanzeigen\.de")
 
 
 def main():
@@ -7,23 +10,38 @@ def main():
     ap.add_argument("user_id")
     ap.add_argument("immowelt_url")
     args = ap.parse_args()
+    from pymongo import ReturnDocument
+    from miniapp.user_manager import UserManager
 
     uid = str(args.user_id)
     new_url = args.immowelt_url.strip()
     um = UserManager()
-    f = um.get_user_filters(uid) or {"search_urls": [], "preferred_locations": []}
-    urls = f.get("search_urls", [])
-    # Rebuild clean list: keep exactly one kleinanzeigen (if exists) and one immowelt (new)
-    cleaned = []
-    seen_klein = False
-    for u in urls:
-        if isinstance(u, str) and "kleinanzeigen.de" in u and not seen_klein:
-            cleaned.append(u)
-            seen_klein = True
-    cleaned.append(new_url)
-    um.set_user_links(uid, cleaned, f.get("preferred_locations", []))
+    # Rebuild clean list server-side in one atomic call:
+    # keep exactly one kleinanzeigen (if exists) and one immowelt (new)
+    klein = {
+        "$filter": {
+            "input": {"$ifNull": ["$search_urls", []]},
+            "as": "u",
+            "cond": {"$and": [
+                {"$eq": [{"$type": "$$u"}, "string"]},
+                {"$regexMatch": {"input": "$$u", "regex": KLEIN_RE}},
+            ]},
+        }
+    }
+    f = um.db.user_filters.find_one_and_update(
+        {"user_id": uid},
+        [{"$set": {
+            "user_id": uid,
+            "search_urls": {"$concatArrays": [{"$slice": [klein, 1]}, [new_url]]},
+            "preferred_locations": {"$ifNull": ["$preferred_locations", []]},
+            **UserManager.links_assigned_fields(datetime.utcnow().isoformat()),
+        }}],
+        projection={"search_urls": 1, "_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    ) or {}
     print("Updated search_urls:")
-    for u in cleaned:
+    for u in f.get("search_urls", []):
         print("-", u)
 
 
@@ -1,18 +1,27 @@
+import re
 from miniapp.parsers.base import BaseParser
-from bs4 import BeautifulSoup
 
 url = 'https://www.kleinanzeigen.de/s-wohnung-mieten/koblenz/c203l5419'
 
+# Byte-level scan: no DOM is needed to count 'heute' cards
+CARD_RE = re.compile(rb'<article[^>]*\baditem\b.*?</article>', re.S)
+HEUTE_RE = re.compile(rb'heute', re.I)
+TAG_RE = re.compile(rb'<[^>]+>')
+WS_RE = re.compile(rb'\s+')
+
 bp = BaseParser()
-soup = bp.get(url)
-cards = soup.select('article.aditem')
+raw = bp.get_bytes(url)
+print('heute (page upper bound)', raw.lower().count(b'heute'))
+cards = CARD_RE.findall(raw)
 print('cards', len(cards))
 heute = 0
 for i, c in enumerate(cards):
-    t = (c.select_one('.aditem-main--bottom') or c).get_text(' ', strip=True).lower()
-    if 'heute' in t:
+    # Match visible text only, not attributes/URLs/alt text
+    text = TAG_RE.sub(b' ', c)
+    if HEUTE_RE.search(text):
         heute += 1
         if heute <= 3:
             print('sample heute card', i)
-            print(t[:200])
+            t = WS_RE.sub(b' ', text).strip()
+            print(t.decode('utf-8', 'replace').lower()[:200])
 print('heute', heute)
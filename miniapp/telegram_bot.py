@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
-from typing import Dict, Any, List
+import asyncio
+import atexit
+import logging
+import queue
+import re
+import time
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Any, List, Awaitable, Callable, Iterable
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -12,25 +21,135 @@ from telegram import (
     BotCommandScopeChat,
     LinkPreviewOptions,
 )
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, ConversationHandler, CallbackQueryHandler
-from .config import TELEGRAM_BOT_TOKEN, TELEGRAM_ADMIN_CHAT_ID, SUPPORT_CONTACT
-from .user_manager import UserManager
+from pymongo.errors import OperationFailure
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import Application, CommandHandler, ContextTypes, Defaults, MessageHandler, filters, ConversationHandler, CallbackQueryHandler, TypeHandler
+from .cache import LRUCache, TTLCache
+from .config import (
+    TELEGRAM_BOT_TOKEN,
+    TELEGRAM_ADMIN_CHAT_ID,
+    TELEGRAM_CONNECTION_POOL_SIZE,
+    TELEGRAM_POOL_TIMEOUT,
+    TELEGRAM_CONNECT_TIMEOUT,
+    TELEGRAM_READ_TIMEOUT,
+    SUPPORT_CONTACT,
+)
+from .user_manager import UserManager, BROADCAST_CRITERIA, FILTER_VIEW_FIELDS, FILTER_PREVIEW_FIELDS
 from .runner import async_run_for_user, async_run_cycle
-from .translations import get_text, LANGUAGE_NAMES
+from .translations import get_text, get_lang_dict, LANGUAGE_NAMES
+
+logger = logging.getLogger(__name__)
 
 um = UserManager()
 
+_URL_RE = re.compile(r"https?://\S+")
+
+
+def _links_preview(links: List[str], limit: int = 5) -> str:
+    """Bulleted list of the first `limit` links plus a count of the rest."""
+    preview = "\n".join("• " + url for url in links[:limit])
+    if len(links) > limit:
+        preview += f"\n... та ще {len(links) - limit} посилань"
+    return preview
+
+
+# Immediate per-user runs requested by admin actions go through a small worker pool, so a
+# burst of assignments doesn't start dozens of scrapers at once. A user already queued or
+# running is not queued again.
+_RUN_WORKERS = 4
+# Bounded so a burst of admin actions gets pushed back instead of piling up unbounded work
+_RUN_QUEUE_SIZE = 200
+_RUN_BUSY_TEXT = "⏳ Черга парсингу переповнена, запуск не заплановано. Спробуйте пізніше."
+_run_queue: asyncio.Queue | None = None
+_run_inflight: set[str] = set()
+
+
+async def _run_worker():
+    while True:
+        uid = await _run_queue.get()
+        try:
+            await async_run_for_user(uid, ignore_window=True)
+        except Exception:
+            logger.exception("Immediate run for %s failed", uid)
+        finally:
+            _run_inflight.discard(uid)
+            _run_queue.task_done()
+
+
+def _enqueue_run(application: Application, uid: str) -> bool:
+    """Queue an immediate parse for uid (no-op if one is already pending).
+    Returns False only if the queue is full and the run was dropped."""
+    global _run_queue
+    if _run_queue is None:
+        # Started lazily: main.py replaces post_init, so there is no reliable startup hook here
+        _run_queue = asyncio.Queue(maxsize=_RUN_QUEUE_SIZE)
+        for _ in range(_RUN_WORKERS):
+            application.create_task(_run_worker())
+    if uid in _run_inflight:
+        return True
+    try:
+        _run_queue.put_nowait(uid)
+    except asyncio.QueueFull:
+        logger.warning("Run queue full, dropping immediate run for %s", uid)
+        return False
+    _run_inflight.add(uid)
+    return True
+
+
+async def _request_run(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: str) -> bool:
+    """_enqueue_run for handlers: tells the admin when the run could not be queued."""
+    if not context.application:
+        return False
+    if _enqueue_run(context.application, uid):
+        return True
+    try:
+        await update.effective_message.reply_text(_RUN_BUSY_TEXT)
+    except Exception:
+        pass
+    return False
+
+
+_now_iso_cache: tuple[int, str] = (0, "")
+
+
+def _now_iso() -> str:
+    """UTC now as an ISO string for Mongo filters, recomputed at most once per second."""
+    global _now_iso_cache
+    sec = int(time.time())
+    if sec != _now_iso_cache[0]:
+        _now_iso_cache = (sec, datetime.utcfromtimestamp(sec).isoformat())
+    return _now_iso_cache[1]
+
 # Track last sent inline menu message per user so we can edit instead of spamming new ones
-_user_menu_messages: Dict[str, Dict[str, int]] = {}
-_admin_menu_messages: Dict[str, Dict[str, int]] = {}
-_reply_kb_set: set[str] = set()  # Users who have received the persistent reply keyboard
+# Bounded so long-running processes do not keep every user who ever pressed /start
+_MENU_TRACK_SIZE = 50_000
+_user_menu_messages = LRUCache(maxsize=_MENU_TRACK_SIZE)  # uid -> {"chat_id", "message_id", "text", "kb"}
+_admin_menu_messages = LRUCache(maxsize=_MENU_TRACK_SIZE)
+_reply_kb_set = LRUCache(maxsize=_MENU_TRACK_SIZE)  # Users who have received the persistent reply keyboard
+
+def _menu_unchanged(msg_info: Dict[str, Any], text: str, kb: InlineKeyboardMarkup) -> bool:
+    """True if the tracked menu message already shows exactly this text and keyboard.
+    Telegram rejects such an edit ("message is not modified"), so callers skip straight to
+    re-sending the menu. Keyboards are shared prebuilt objects, so identity is enough."""
+    return msg_info.get("kb") is kb and msg_info.get("text") == text
+
+
+def _forget_menu_content(uid: str, message_id: int):
+    """Drop the recorded text/keyboard if message_id is uid's tracked menu message.
+    Used when a handler may have edited that message in place, so the next menu refresh
+    edits it back instead of trusting a stale snapshot."""
+    for tracked in (_user_menu_messages, _admin_menu_messages):
+        msg_info = tracked.get(uid)
+        if msg_info and msg_info["message_id"] == message_id:
+            msg_info.update(text=None, kb=None)
+
 
 async def _ensure_user_menu(context: ContextTypes.DEFAULT_TYPE, uid: str, welcome_text: str):
     """Ensure a single persistent inline menu message exists for user; edit if already sent."""
     try:
         msg_info = _user_menu_messages.get(uid)
         kb = _user_menu_keyboard(uid)
-        if msg_info:
+        if msg_info and not _menu_unchanged(msg_info, welcome_text, kb):
             # Try edit existing message text + keyboard
             try:
                 await context.bot.edit_message_text(
@@ -39,13 +158,14 @@ async def _ensure_user_menu(context: ContextTypes.DEFAULT_TYPE, uid: str, welcom
                     text=welcome_text,
                     reply_markup=kb
                 )
+                msg_info.update(text=welcome_text, kb=kb)
                 return
             except Exception:
                 pass  # Fall through to send new
         sent = await context.bot.send_message(chat_id=uid, text=welcome_text, reply_markup=kb)
-        _user_menu_messages[uid] = {"chat_id": sent.chat_id, "message_id": sent.message_id}
+        _user_menu_messages[uid] = {"chat_id": sent.chat_id, "message_id": sent.message_id, "text": welcome_text, "kb": kb}
     except Exception as e:
-        print(f"Failed ensuring user menu for {uid}: {e}")
+        logger.warning("Failed ensuring user menu for %s: %s", uid, e)
 
 async def _ensure_admin_menu(context: ContextTypes.DEFAULT_TYPE, uid: str):
     """Ensure single persistent admin menu message exists; edit if possible."""
@@ -53,7 +173,7 @@ async def _ensure_admin_menu(context: ContextTypes.DEFAULT_TYPE, uid: str):
         msg_info = _admin_menu_messages.get(uid)
         kb = _admin_menu_keyboard()
         text = "Адмін-меню:"
-        if msg_info:
+        if msg_info and not _menu_unchanged(msg_info, text, kb):
             try:
                 await context.bot.edit_message_text(
                     chat_id=msg_info["chat_id"],
@@ -61,13 +181,14 @@ async def _ensure_admin_menu(context: ContextTypes.DEFAULT_TYPE, uid: str):
                     text=text,
                     reply_markup=kb
                 )
+                msg_info.update(text=text, kb=kb)
                 return
             except Exception:
                 pass
         sent = await context.bot.send_message(chat_id=uid, text=text, reply_markup=kb)
-        _admin_menu_messages[uid] = {"chat_id": sent.chat_id, "message_id": sent.message_id}
+        _admin_menu_messages[uid] = {"chat_id": sent.chat_id, "message_id": sent.message_id, "text": text, "kb": kb}
     except Exception as e:
-        print(f"Failed ensuring admin menu for {uid}: {e}")
+        logger.warning("Failed ensuring admin menu for %s: %s", uid, e)
 
 WELCOME_TEXT = (
     """🏠 Хочеш знайти квартиру в Німеччині швидко та без стресу?
@@ -86,45 +207,46 @@ WELCOME_TEXT = (
 )
 
 # Support one or multiple admin IDs (comma-separated)
-_admin_ids = set()
-if TELEGRAM_ADMIN_CHAT_ID:
-    for part in str(TELEGRAM_ADMIN_CHAT_ID).split(","):
-        s = part.strip()
-        if s:
-            _admin_ids.add(s)
+_admin_ids: frozenset[str] = frozenset(
+    s for s in (part.strip() for part in str(TELEGRAM_ADMIN_CHAT_ID or "").split(",")) if s
+)
+# Telegram delivers user ids as ints; compare against ints to avoid str() on every update
+_admin_int_ids: frozenset[int] = frozenset(int(s) for s in _admin_ids if s.lstrip("-").isdigit())
+# is_admin(user_id) -> bool, bound directly to the frozenset lookup (no wrapper frame per update)
+is_admin = _admin_int_ids.__contains__
+
 
-def is_admin(user_id: str) -> bool:
-    return user_id in _admin_ids
+_LANG_SELECT_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton(get_text("language_ukrainian", "uk"), callback_data="lang_uk")],
+    [InlineKeyboardButton(get_text("language_russian", "ru"), callback_data="lang_ru")],
+    [InlineKeyboardButton(get_text("language_arabic", "ar"), callback_data="lang_ar")],
+])
 
 
 def _language_selection_keyboard():
-    """Build language selection keyboard with 3 languages."""
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton(get_text("language_ukrainian", "uk"), callback_data="lang_uk")],
-        [InlineKeyboardButton(get_text("language_russian", "ru"), callback_data="lang_ru")],
-        [InlineKeyboardButton(get_text("language_arabic", "ar"), callback_data="lang_ar")],
-    ])
+    """Language selection keyboard with 3 languages."""
+    return _LANG_SELECT_KB
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    uid = str(u.id)
-    if is_admin(uid):
+    uid = context.user_data["uid"]
+    if is_admin(u.id):
         # Ensure admin is recorded as active admin, no pending text
         um.upsert_user(uid, u.username or "", u.first_name or "", u.last_name or "")
         um.db.users.update_one(
             {"user_id": uid},
             {"$set": {"role": "admin", "status": "active", "date_activated": datetime.utcnow().isoformat(), "language": "uk"}},
         )
+        um.invalidate_user(uid)
         await _ensure_admin_menu(context, uid)
         return
     
-    # Regular user path: register/update user
-    um.upsert_user(uid, u.username or "", u.first_name or "", u.last_name or "")
+    # Regular user path: register/update user and read it back in the same round-trip
+    user_doc = um.upsert_and_get(uid, u.username or "", u.first_name or "", u.last_name or "")
     
-    # Check if user has already selected a language by checking the database directly
-    user_doc = um.db.users.find_one({"user_id": uid})
-    user_lang = user_doc.get("language") if user_doc else None
+    # Check if user has already selected a language on the user document
+    user_lang = user_doc.get("language")
     
     if user_lang is None:
         # User hasn't selected a language yet, show language selection
@@ -137,7 +259,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             rk = ReplyKeyboardMarkup([["Меню"]], resize_keyboard=True)
             try:
                 await update.message.reply_text("Натисни 'Меню' щоб відкрити панель", reply_markup=rk)
-                _reply_kb_set.add(uid)
+                _reply_kb_set[uid] = True
             except Exception:
                 pass
     else:
@@ -148,11 +270,40 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             rk = ReplyKeyboardMarkup([[label]], resize_keyboard=True)
             try:
                 await update.message.reply_text(get_text("menu_hint", user_lang), reply_markup=rk)
-                _reply_kb_set.add(uid)
+                _reply_kb_set[uid] = True
             except Exception:
                 pass
 
 
+_TRIAL_FIELDS = {"_id": 0, "trial_expires_at": 1}
+
+
+def _still_open(until: str | None, now: datetime) -> bool:
+    if not until:
+        return False
+    try:
+        return datetime.fromisoformat(until) >= now
+    except Exception:
+        return False
+
+
+def _active_access(u: Dict[str, Any], uid: str) -> tuple[str | None, str | None]:
+    """(paid_until, trial_until) for the access windows still open, None where closed.
+    The trial window lives in user_filters and is only looked up if no paid period is running."""
+    now = datetime.utcnow()
+    paid_until = u.get("subscription_expires")
+    if _still_open(paid_until, now):
+        return paid_until, None
+    trial_until = (um.get_user_filters(uid, _TRIAL_FIELDS) or {}).get("trial_expires_at")
+    return None, (trial_until if _still_open(trial_until, now) else None)
+
+
+# uid -> (user document the menu was derived from, markup). Every write through UserManager
+# (language, trial, subscription, links) and um.invalidate_user() replaces or evicts the cached
+# user document, so an identity check against the current one is the invalidation.
+_menu_cache = TTLCache(maxsize=20_000, ttl=60)
+
+
 def _user_menu_keyboard(uid: str | None = None):
     """Build user menu.
     
@@ -167,57 +318,69 @@ def _user_menu_keyboard(uid: str | None = None):
       * "Техпідтримка"
       * "Змінити мову"
     """
-    rows = []
     has_active_sub = False
     user_lang = "uk"  # Default language
     
     if uid is not None:
-        u = um.db.users.find_one({"user_id": uid}) or {}
+        u = um.get_user(uid)
+        cached = _menu_cache.get(uid)
+        if cached is not None and cached[0] is u:
+            return cached[1]
         user_lang = u.get("language", "uk")
-        
         # Determine if user already має активний доступ (trial або підписка)
-        from datetime import datetime as _dt
-        now_iso = _dt.utcnow().isoformat()
+        has_active_sub = any(_active_access(u, uid))
 
-        # Check paid subscription
-        sub_expires = u.get("subscription_expires")
-        if sub_expires:
-            try:
-                has_active_sub = _dt.fromisoformat(sub_expires) >= _dt.fromisoformat(now_iso)
-            except Exception:
-                has_active_sub = False
+    kb = _USER_MENU_KBS.get((user_lang, has_active_sub)) or _build_user_menu_keyboard(user_lang, has_active_sub)
+    if uid is not None:
+        _menu_cache[uid] = (u, kb)
+    return kb
 
-        # Check trial in filters
-        f = um.db.user_filters.find_one({"user_id": uid}) or {}
-        trial_expires = f.get("trial_expires_at")
-        if trial_expires and not has_active_sub:
-            try:
-                has_active_sub = _dt.fromisoformat(trial_expires) >= _dt.fromisoformat(now_iso)
-            except Exception:
-                pass
 
+def _build_user_menu_keyboard(user_lang: str, has_active_sub: bool) -> InlineKeyboardMarkup:
+    t = get_lang_dict(user_lang)
+    rows = []
     # Show "Try free" button only if user doesn't have active subscription
     if not has_active_sub:
-        rows.append([InlineKeyboardButton(get_text("btn_start_free", user_lang), callback_data="user_subscribe")])
+        rows.append([InlineKeyboardButton(t["btn_start_free"], callback_data="user_subscribe")])
     
     # Show subscription info button if user has active subscription
     if has_active_sub:
-        rows.append([InlineKeyboardButton(get_text("btn_subscription_date", user_lang), callback_data="user_sub_info")])
+        rows.append([InlineKeyboardButton(t["btn_subscription_date"], callback_data="user_sub_info")])
     
     # Show "Add more cities" button always so user can update or submit search params
-    rows.append([InlineKeyboardButton(get_text("btn_add_cities", user_lang), callback_data="user_add_cities")])
+    rows.append([InlineKeyboardButton(t["btn_add_cities"], callback_data="user_add_cities")])
     
     # Support button always visible
-    rows.append([InlineKeyboardButton(get_text("btn_support", user_lang), callback_data="user_support")])
+    rows.append([InlineKeyboardButton(t["btn_support"], callback_data="user_support")])
     
     # Language change button
-    rows.append([InlineKeyboardButton(get_text("btn_change_language", user_lang), callback_data="user_change_lang")])
+    rows.append([InlineKeyboardButton(t["btn_change_language"], callback_data="user_change_lang")])
 
     return InlineKeyboardMarkup(rows)
 
 
+# Keyboards are immutable and only vary by language / access state: build them once
+_USER_MENU_KBS: Dict[tuple, InlineKeyboardMarkup] = {
+    (lang, active): _build_user_menu_keyboard(lang, active)
+    for lang in LANGUAGE_NAMES for active in (False, True)
+}
+_BACK_KBS: Dict[str, InlineKeyboardMarkup] = {
+    lang: InlineKeyboardMarkup([[InlineKeyboardButton(get_text("btn_back_menu", lang), callback_data="user_back_menu")]])
+    for lang in LANGUAGE_NAMES
+}
+
+_SETUP_CANCEL_KBS: Dict[str, InlineKeyboardMarkup] = {
+    lang: InlineKeyboardMarkup([[InlineKeyboardButton(get_text("btn_back_menu", lang), callback_data="user_setup_cancel")]])
+    for lang in LANGUAGE_NAMES
+}
+
+
 def _back_to_menu_keyboard(lang: str = "uk"):
-    return InlineKeyboardMarkup([[InlineKeyboardButton(get_text("btn_back_menu", lang), callback_data="user_back_menu")]])
+    return _BACK_KBS.get(lang) or _BACK_KBS["uk"]
+
+
+def _setup_cancel_keyboard(lang: str = "uk"):
+    return _SETUP_CANCEL_KBS.get(lang) or _SETUP_CANCEL_KBS["uk"]
 
 
 async def _send_setup_complete_notification(
@@ -245,13 +408,12 @@ async def _send_setup_complete_notification(
         else:
             await _ensure_user_menu(context, target_id, "✅ Пошук оновлено.")
     except Exception as e:
-        print(f"Failed to send setup notification to user {target_id}: {e}")
+        logger.warning("Failed to send setup notification to user %s: %s", target_id, e)
 
 
 async def approve(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # /approve <user_id>
-    caller_id = str(update.effective_user.id)
-    if not is_admin(caller_id):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     if not context.args:
@@ -263,8 +425,7 @@ async def approve(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def set_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # /set_location <user_id> <comma-separated links> | optional: ; cities=City1,City2
-    caller_id = str(update.effective_user.id)
-    if not is_admin(caller_id):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     if not context.args:
@@ -285,13 +446,11 @@ async def set_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user_and_links[:first_space].strip()
     links_part = user_and_links[first_space+1:].strip()
     # Robust URL extraction: find all http/https links, don't split by comma
-    import re as _re
-    links = _re.findall(r"https?://\S+", links_part)
+    links = list(dict.fromkeys(_URL_RE.findall(links_part)))
     um.set_user_links(user_id, links, cities)
     await update.message.reply_text(f"Оновлено посилання для {user_id}. Міста: {', '.join(cities) if cities else '—'}")
     # Trigger immediate async parsing for this user
-    if context.application:
-        context.application.create_task(async_run_for_user(user_id, ignore_window=True))
+    await _request_run(update, context, user_id)
 
 async def view_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # /view_location <user_id>
@@ -300,7 +459,7 @@ async def view_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Використання: /view_location <user_id>")
         return
     user_id = context.args[0]
-    f = um.get_user_filters(user_id)
+    f = um.get_user_filters(user_id, FILTER_VIEW_FIELDS)
     if not f:
         await update.message.reply_text("Фільтри не знайдені.")
         return
@@ -309,42 +468,45 @@ async def view_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "\nМіста: " + ", ".join(f.get("preferred_locations", []))
     )
 
+
+_HELP_ADMIN_TEXT = (
+    "🔧 Команди адміністратора:\n\n"
+    "📋 Основні команди:\n"
+    "/start — почати роботу з ботом\n"
+    "/admin — відкрити адмін-меню\n"
+    "/users — список користувачів та посилань\n"
+    "/help — показати цю довідку\n\n"
+    "➕ Додавання посилань (найпростіші способи):\n"
+    "/add_link <user_id або @username> <посилання...> — ШВИДКЕ додавання посилань\n"
+    "/assign_links <user_id або @username> <посилання...> — те саме що /add_link\n"
+    "/reply_assign — відповісти Reply на повідомлення з посиланнями для призначення\n\n"
+    "👥 Управління користувачами:\n"
+    "/approve <user_id> — схвалити користувача\n"
+    "/delete_user <user_id> — видалити користувача\n"
+    "/view_location <user_id> — переглянути міста/посилання користувача\n\n"
+    "⚙️ Налаштування:\n"
+    "/set_location <user_id> <посилання...> ; cities=Місто1,Місто2 — детальне налаштування\n"
+    "/set_links <url1 url2 ...> — задати посилання собі\n\n"
+    "🚀 Інше:\n"
+    "/test_run — тестовий запуск парсингу\n"
+    "/broadcast <текст> — розсилка повідомлення всім користувачам\n\n"
+    "💡 Підказка: для швидкого додавання посилань просто використайте /add_link або /reply_assign!\n"
+)
+_HELP_USER_TEXT = (
+    "Команди користувача:\n/start — показати меню та кнопки.\n"
+    "Використовуйте кнопки для підтримки та перегляду дати старту підписки."
+)
+
+
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = str(update.effective_user.id)
-    if is_admin(uid):
-        await update.message.reply_text(
-            "🔧 Команди адміністратора:\n\n"
-            "📋 Основні команди:\n"
-            "/start — почати роботу з ботом\n"
-            "/admin — відкрити адмін-меню\n"
-            "/users — список користувачів та посилань\n"
-            "/help — показати цю довідку\n\n"
-            "➕ Додавання посилань (найпростіші способи):\n"
-            "/add_link <user_id або @username> <посилання...> — ШВИДКЕ додавання посилань\n"
-            "/assign_links <user_id або @username> <посилання...> — те саме що /add_link\n"
-            "/reply_assign — відповісти Reply на повідомлення з посиланнями для призначення\n\n"
-            "👥 Управління користувачами:\n"
-            "/approve <user_id> — схвалити користувача\n"
-            "/delete_user <user_id> — видалити користувача\n"
-            "/view_location <user_id> — переглянути міста/посилання користувача\n\n"
-            "⚙️ Налаштування:\n"
-            "/set_location <user_id> <посилання...> ; cities=Місто1,Місто2 — детальне налаштування\n"
-            "/set_links <url1 url2 ...> — задати посилання собі\n\n"
-            "🚀 Інше:\n"
-            "/test_run — тестовий запуск парсингу\n"
-            "/broadcast <текст> — розсилка повідомлення всім користувачам\n\n"
-            "💡 Підказка: для швидкого додавання посилань просто використайте /add_link або /reply_assign!\n"
-        )
-    else:
-        await update.message.reply_text(
-            "Команди користувача:\n/start — показати меню та кнопки.\n"
-            "Використовуйте кнопки для підтримки та перегляду дати старту підписки."
-        )
+    await update.message.reply_text(
+        _HELP_ADMIN_TEXT if is_admin(update.effective_user.id) else _HELP_USER_TEXT
+    )
 
 
 async def support_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """User command: /support — show support contact."""
-    print("/support command received from", update.effective_user.id)
+    logger.info("/support from %s", context.user_data["uid"])
     contact = SUPPORT_CONTACT or "@admin"
     try:
         await update.message.reply_text(
@@ -352,31 +514,24 @@ async def support_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=_back_to_menu_keyboard(),
         )
     except Exception:
-        import traceback; print("Error in /support:", traceback.format_exc())
+        logger.exception("Error in /support")
 
 
 async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """User command: /status — show subscription start/end dates or state."""
-    print("/status command received from", update.effective_user.id)
-    uid = str(update.effective_user.id)
-    u = um.db.users.find_one({"user_id": uid})
-    status = (u or {}).get("status")
-    date_activated = (u or {}).get("date_activated")
-    subscription_expires = (u or {}).get("subscription_expires")
-    requested = (u or {}).get("requested_subscription")
-    now_iso = datetime.utcnow().isoformat()
+    uid = context.user_data["uid"]
+    logger.info("/status from %s", uid)
+    u = um.get_user(uid)
+    status = u.get("status")
+    date_activated = u.get("date_activated")
+    subscription_expires = u.get("subscription_expires")
+    requested = u.get("requested_subscription")
+    now_iso = _now_iso()
     active_valid = (
         status == "active" and subscription_expires and subscription_expires >= now_iso
     )
-    # Format as DD.MM.YYYY
-    def _fmt_date(iso: str) -> str:
-        try:
-            from datetime import datetime as _dt
-            return _dt.fromisoformat(iso).strftime("%d.%m.%Y")
-        except Exception:
-            return iso
     if active_valid and subscription_expires:
-        msg = f"📅 Підписка активна до: {_fmt_date(subscription_expires)}"
+        msg = f"📅 Підписка активна до: {_fmt_dt(subscription_expires)}"
     elif requested:
         msg = "⏳ Заявка на підписку очікує підтвердження адміністратора."
     else:
@@ -384,20 +539,20 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await update.message.reply_text(msg, reply_markup=_back_to_menu_keyboard())
     except Exception:
-        import traceback; print("Error in /status:", traceback.format_exc())
+        logger.exception("Error in /status")
 
 
 async def add_cities_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """User command: /add_cities — start the add cities setup flow."""
-    print("/add_cities command received from", update.effective_user.id)
-    uid = str(update.effective_user.id)
+    uid = context.user_data["uid"]
+    logger.info("/add_cities from %s", uid)
     
     try:
         # Get user's language
         user_lang = um.get_user_language(uid)
         
         # Show warning about overwriting parameters
-        cancel_kb = InlineKeyboardMarkup([[InlineKeyboardButton(get_text("btn_back_menu", user_lang), callback_data="user_setup_cancel")]])
+        cancel_kb = _setup_cancel_keyboard(user_lang)
         await update.message.reply_text(
             get_text("setup_add_cities_warning", user_lang),
             reply_markup=cancel_kb
@@ -409,17 +564,12 @@ async def add_cities_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=cancel_kb
         )
         
-        # Store language in context for conversation
-        context.user_data["setup_user_lang"] = user_lang
-        context.user_data["setup_user_id"] = uid
-        context.user_data["setup_from_menu"] = True  # Mark that this request is from menu
+        _setup_state(context, lang=user_lang, uid=uid, from_menu=True)
         
         return USER_SETUP_ASK_CITY
         
-    except Exception as e:
-        print(f"Error starting add cities for {uid}: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Error starting add cities for %s", uid)
         return ConversationHandler.END
 
 
@@ -428,8 +578,7 @@ async def assign_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Usage: /assign_links <user_id_or_username> <url1> <url2> ...
     Admin will be asked to choose between trial and subscription mode.
     """
-    caller_id = str(update.effective_user.id)
-    if not is_admin(caller_id):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     
@@ -446,8 +595,7 @@ async def assign_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_identifier = context.args[0].lstrip("@")
     links_str = " ".join(context.args[1:]).strip()
     
-    import re as _re
-    links = _re.findall(r"https?://\S+", links_str)
+    links = list(dict.fromkeys(_URL_RE.findall(links_str)))
     
     if not links:
         await update.message.reply_text("❌ Не знайдено жодного посилання. Переконайтеся, що ви вказали URL.")
@@ -456,9 +604,9 @@ async def assign_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Find user by ID or username
     user_doc = None
     if user_identifier.isdigit():
-        user_doc = um.db.users.find_one({"user_id": user_identifier})
+        user_doc = um.get_user(user_identifier)
     else:
-        user_doc = um.db.users.find_one({"username": {"$regex": f"^{user_identifier}$", "$options": "i"}})
+        user_doc = um.find_user_by_username(user_identifier)
     
     if not user_doc:
         await update.message.reply_text(
@@ -476,17 +624,9 @@ async def assign_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["quick_assign_label"] = label
     
     # Ask admin to choose mode
-    kb = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("🧪 Тест (14 днів)", callback_data="quick_assign_trial"),
-            InlineKeyboardButton("💳 Підписка (30 днів)", callback_data="quick_assign_subscription")
-        ],
-        [InlineKeyboardButton("❌ Скасувати", callback_data="quick_assign_cancel")]
-    ])
+    kb = _QUICK_ASSIGN_KB
     
-    links_preview = "\n".join([f"• {url}" for url in links[:5]])
-    if len(links) > 5:
-        links_preview += f"\n... та ще {len(links) - 5} посилань"
+    links_preview = _links_preview(links)
     
     await update.message.reply_text(
         f"📋 Призначення посилань для користувача:\n"
@@ -501,8 +641,7 @@ async def reply_assign(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Assign links from a user's message by replying to it.
     Admin replies to user's message containing links with /reply_assign command.
     """
-    caller_id = str(update.effective_user.id)
-    if not is_admin(caller_id):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     
@@ -526,8 +665,7 @@ async def reply_assign(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_id = str(target_user.id)
     
     # Extract links from the replied message
-    import re as _re
-    links = _re.findall(r"https?://\S+", replied_msg.text or "")
+    links = list(dict.fromkeys(_URL_RE.findall(replied_msg.text or "")))
     
     if not links:
         await update.message.reply_text(
@@ -537,11 +675,11 @@ async def reply_assign(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Ensure user exists in database
-    user_doc = um.db.users.find_one({"user_id": target_id})
+    user_doc = um.get_user(target_id)
     if not user_doc:
         # Create user record
         um.upsert_user(target_id, target_user.username or "", target_user.first_name or "", target_user.last_name or "")
-        user_doc = um.db.users.find_one({"user_id": target_id})
+        user_doc = um.get_user(target_id)
     
     label = user_doc.get("username") or user_doc.get("first_name") or target_id
     
@@ -551,17 +689,9 @@ async def reply_assign(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["quick_assign_label"] = label
     
     # Ask admin to choose mode
-    kb = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("🧪 Тест (14 днів)", callback_data="quick_assign_trial"),
-            InlineKeyboardButton("💳 Підписка (30 днів)", callback_data="quick_assign_subscription")
-        ],
-        [InlineKeyboardButton("❌ Скасувати", callback_data="quick_assign_cancel")]
-    ])
+    kb = _QUICK_ASSIGN_KB
     
-    links_preview = "\n".join([f"• {url}" for url in links[:5]])
-    if len(links) > 5:
-        links_preview += f"\n... та ще {len(links) - 5} посилань"
+    links_preview = _links_preview(links)
     
     await update.message.reply_text(
         f"📋 Призначення посилань для користувача:\n"
@@ -574,23 +704,21 @@ async def reply_assign(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def set_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Admin helper to set links for yourself quickly
-    caller_id = str(update.effective_user.id)
-    if not is_admin(caller_id):
+    caller_id = context.user_data["uid"]
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     if not context.args:
         await update.message.reply_text("Використання: /set_links <url1,url2,...>")
         return
     links_str = " ".join(context.args).strip()
-    import re as _re
-    links = _re.findall(r"https?://\S+", links_str)
+    links = list(dict.fromkeys(_URL_RE.findall(links_str)))
     um.set_user_links(caller_id, links, [])
     await update.message.reply_text("Посилання оновлено для адміністратора.")
 
 
 async def test_run(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    caller_id = str(update.effective_user.id)
-    if not is_admin(caller_id):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     if context.application:
@@ -599,78 +727,140 @@ async def test_run(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def force_run_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    caller_id = str(update.effective_user.id)
-    if not is_admin(caller_id):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     if not context.args:
         await update.message.reply_text("Використання: /force_run <user_id>")
         return
     target = context.args[0]
-    if context.application:
-        context.application.create_task(async_run_for_user(target, ignore_window=True))
-    await update.message.reply_text(f"Примусовий запуск для {target} заплановано.")
+    if await _request_run(update, context, target):
+        await update.message.reply_text(f"Примусовий запуск для {target} заплановано.")
 
 
 async def refresh_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin-only: force refresh bot commands in Telegram.
     Usage: /refresh_commands
     """
-    caller_id = str(update.effective_user.id)
-    if not is_admin(caller_id):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     
-    try:
-        # Delete all commands first
-        await context.bot.delete_my_commands()
-        
-        # Hide default user commands completely (no visible slash menu for regular users)
-        await context.bot.delete_my_commands(scope=BotCommandScopeDefault())
-        await context.bot.set_my_commands([], scope=BotCommandScopeDefault())
-        await context.bot.delete_my_commands(scope=BotCommandScopeAllPrivateChats())
-        await context.bot.set_my_commands([], scope=BotCommandScopeAllPrivateChats())
-        
-        # Set admin commands for each admin
-        for aid in _admin_ids:
-            await context.bot.set_my_commands(
-                [
-                    BotCommand("start", "Почати (адмін)"),
-                    BotCommand("admin", "Відкрити адмін-меню"),
-                    BotCommand("users", "Список користувачів та посилань"),
-                    BotCommand("add_link", "Швидко додати посилання користувачу"),
-                    BotCommand("assign_links", "Призначити посилання користувачу"),
-                    BotCommand("reply_assign", "Призначити посилання відповіддю на повідомлення"),
-                    BotCommand("approve", "Схвалити користувача"),
-                    BotCommand("set_location", "Призначити міста/посилання"),
-                    BotCommand("view_location", "Переглянути міста/посилання"),
-                    BotCommand("delete_user", "Видалити користувача"),
-                    BotCommand("set_links", "Задати посилання собі"),
-                    BotCommand("test_run", "Тестовий запуск парсингу"),
-                    BotCommand("broadcast", "Розсилка повідомлення всім"),
-                    BotCommand("refresh_commands", "Оновити команди бота"),
-                    BotCommand("support", "Техпідтримка"),
-                    BotCommand("status", "Статус підписки"),
-                    BotCommand("help", "Список адмін-команд"),
-                ],
-                scope=BotCommandScopeChat(int(aid)),
-            )
-        
+    failed = await _sync_commands(context.bot)
+    if failed:
+        await update.message.reply_text("❌ Помилка оновлення команд:\n" + "\n".join(failed))
+    else:
         await update.message.reply_text(
             "✅ Команди оновлено. Меню користувача повністю приховано, адмінські команди активні."
         )
-    except Exception as e:
-        await update.message.reply_text(f"❌ Помилка оновлення команд: {e}")
-        import traceback
-        traceback.print_exc()
+
+
+_BROADCAST_CONCURRENCY = 30  # in-flight requests; the send rate itself is capped by _TG_BUCKET
+_BROADCAST_PROGRESS_EVERY = 100
+_BROADCAST_CHUNK = 50  # ids pulled from the source per gather, keeps memory flat for large audiences
+
+
+class _TokenBucket:
+    """Async token bucket: at most `rate` acquisitions per `per` seconds, bursting up to `rate`."""
+
+    def __init__(self, rate: float, per: float = 1.0):
+        self.capacity = rate
+        self.fill_rate = rate / per
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.fill_rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.fill_rate)
+
+
+# Shared by every fan-out so concurrent broadcasts together stay under Telegram's global
+# 30 msg/s limit (with headroom for regular replies sent meanwhile)
+_TG_BUCKET = _TokenBucket(25, 1.0)
+_SEND_ATTEMPTS = 3
+
+
+async def _send_to_all(
+    user_ids: Iterable[str],
+    send: Callable[[str], Awaitable[Any]],
+    on_progress: Callable[[int], Awaitable[Any]] | None = None,
+) -> tuple[int, int]:
+    """Run send(uid) for every user with bounded concurrency; returns (success, failed).
+    user_ids may be a lazy iterator (e.g. a DB cursor); it is consumed in chunks in a worker thread.
+    Sends are paced by _TG_BUCKET; a RetryAfter is waited out and transient network errors
+    (timeouts, 5xx) are backed off exponentially, each retried up to _SEND_ATTEMPTS times.
+    Users who blocked the bot (Forbidden) fail immediately and are flagged `blocked`."""
+    sem = asyncio.Semaphore(_BROADCAST_CONCURRENCY)
+    done = 0
+    blocked: List[str] = []
+
+    async def _one(uid: str) -> bool:
+        nonlocal done
+        async with sem:
+            ok = False
+            for attempt in range(_SEND_ATTEMPTS):
+                try:
+                    await _TG_BUCKET.acquire()
+                    await send(uid)
+                    ok = True
+                    break
+                except RetryAfter as e:
+                    if attempt + 1 == _SEND_ATTEMPTS:
+                        logger.warning("Failed to send to %s: still rate limited", uid)
+                        break
+                    await asyncio.sleep(e.retry_after)
+                except Forbidden:
+                    logger.debug("User %s blocked the bot", uid)
+                    blocked.append(uid)
+                    break
+                except BadRequest as e:
+                    logger.warning("Failed to send to %s: %s", uid, e)
+                    break
+                except NetworkError as e:
+                    if attempt + 1 == _SEND_ATTEMPTS:
+                        logger.warning("Failed to send to %s: %s", uid, e)
+                        break
+                    await asyncio.sleep(2 ** attempt)
+                except Exception as e:
+                    logger.warning("Failed to send to %s: %s", uid, e)
+                    break
+        done += 1
+        if on_progress and done % _BROADCAST_PROGRESS_EVERY == 0:
+            try:
+                await on_progress(done)
+            except Exception:
+                pass
+        return ok
+
+    success = failed = 0
+    it = iter(user_ids)
+    # Pulling from a cursor may issue a blocking getMore, so chunks are fetched off the loop
+    while batch := await asyncio.to_thread(lambda: list(islice(it, _BROADCAST_CHUNK))):
+        results = await asyncio.gather(*(_one(uid) for uid in batch), return_exceptions=True)
+        ok = sum(1 for r in results if r is True)
+        success += ok
+        failed += len(results) - ok
+    if blocked:
+        try:
+            um.mark_blocked(blocked)
+        except Exception as e:
+            logger.warning("Failed to flag blocked users: %s", e)
+    return success, failed
 
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin-only: broadcast message to all users (except banned).
     Usage: /broadcast <message text>
     """
-    caller_id = str(update.effective_user.id)
-    if not is_admin(caller_id):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     if not context.args:
@@ -678,140 +868,128 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     message_text = " ".join(context.args)
-    users = um.get_all_users_for_broadcast()
+    total = um.count_users(BROADCAST_CRITERIA)
     
-    if not users:
+    if not total:
         await update.message.reply_text("Немає користувачів для розсилки.")
         return
     
-    await update.message.reply_text(f"Починаю розсилку для {len(users)} користувачів...")
-    
-    success_count = 0
-    fail_count = 0
-    
-    for user in users:
-        user_id = user.get("user_id")
-        if not user_id:
-            continue
-        try:
-            await context.bot.send_message(chat_id=user_id, text=message_text)
-            success_count += 1
-        except Exception as e:
-            fail_count += 1
-            # Optionally log the error
-            print(f"Failed to send to {user_id}: {e}")
-    
-    await update.message.reply_text(
-        f"✅ Розсилка завершена!\n"
-        f"Успішно: {success_count}\n"
-        f"Помилок: {fail_count}"
-    )
+    status_msg = await update.message.reply_text(f"Починаю розсилку у фоні для {total} користувачів...")
 
+    async def _progress(done: int):
+        await status_msg.edit_text(f"Розсилка: надіслано {done}/{total}...")
 
-async def _post_init(app: Application):
-    # Fully clear default user commands (delete + set empty) to flush client cache
-    try:
-        await app.bot.delete_my_commands(scope=BotCommandScopeDefault())
-        await app.bot.set_my_commands([], scope=BotCommandScopeDefault())
-        await app.bot.delete_my_commands(scope=BotCommandScopeAllPrivateChats())
-        await app.bot.set_my_commands([], scope=BotCommandScopeAllPrivateChats())
-    except Exception as e:
-        print(f"Error clearing default user commands: {e}")
-        import traceback; traceback.print_exc()
-    # Set admin-specific commands per admin chat
-    for aid in _admin_ids:
+    async def _run():
+        # Runs in the background so /broadcast returns immediately
         try:
-            await app.bot.set_my_commands(
-                [
-                    BotCommand("start", "Почати (адмін)"),
-                    BotCommand("admin", "Відкрити адмін-меню"),
-                    BotCommand("users", "Список користувачів та посилань"),
-                    BotCommand("add_link", "Швидко додати посилання користувачу"),
-                    BotCommand("assign_links", "Призначити посилання користувачу"),
-                    BotCommand("reply_assign", "Призначити посилання відповіддю на повідомлення"),
-                    BotCommand("approve", "Схвалити користувача"),
-                    BotCommand("set_location", "Призначити міста/посилання"),
-                    BotCommand("view_location", "Переглянути міста/посилання"),
-                    BotCommand("delete_user", "Видалити користувача"),
-                    BotCommand("set_links", "Задати посилання собі"),
-                    BotCommand("test_run", "Тестовий запуск парсингу"),
-                    BotCommand("broadcast", "Розсилка повідомлення всім"),
-                    BotCommand("support", "Техпідтримка"),
-                    BotCommand("status", "Статус підписки"),
-                    BotCommand("help", "Список адмін-команд"),
-                ],
-                scope=BotCommandScopeChat(int(aid)),
+            success_count, fail_count = await _send_to_all(
+                um.iter_users_for_broadcast(),
+                lambda uid: context.bot.send_message(chat_id=uid, text=message_text, disable_notification=True),
+                _progress,
             )
-        except Exception as e:
-            print(f"Error setting admin commands for {aid}: {e}")
-            import traceback
-            traceback.print_exc()
+            await update.message.reply_text(
+                f"✅ Розсилка завершена!\n"
+                f"Успішно: {success_count}\n"
+                f"Помилок: {fail_count}"
+            )
+        except Exception:
+            logger.exception("Broadcast failed")
+
+    context.application.create_task(_run())
+
+
+# Commands shown to admins in their private chat (regular users get no slash menu)
+_ADMIN_CMDS = (
+    BotCommand("start", "Почати (адмін)"),
+    BotCommand("admin", "Відкрити адмін-меню"),
+    BotCommand("users", "Список користувачів та посилань"),
+    BotCommand("add_link", "Швидко додати посилання користувачу"),
+    BotCommand("assign_links", "Призначити посилання користувачу"),
+    BotCommand("reply_assign", "Призначити посилання відповіддю на повідомлення"),
+    BotCommand("approve", "Схвалити користувача"),
+    BotCommand("set_location", "Призначити міста/посилання"),
+    BotCommand("view_location", "Переглянути міста/посилання"),
+    BotCommand("delete_user", "Видалити користувача"),
+    BotCommand("set_links", "Задати посилання собі"),
+    BotCommand("test_run", "Тестовий запуск парсингу"),
+    BotCommand("broadcast", "Розсилка повідомлення всім"),
+    BotCommand("refresh_commands", "Оновити команди бота"),
+    BotCommand("support", "Техпідтримка"),
+    BotCommand("status", "Статус підписки"),
+    BotCommand("help", "Список адмін-команд"),
+)
+
+
+async def _clear_commands(bot, scope):
+    # delete + set empty to flush client cache
+    await bot.delete_my_commands(scope=scope)
+    await bot.set_my_commands([], scope=scope)
+
+
+async def _sync_commands(bot) -> List[str]:
+    """Hide the user slash menu and set per-admin commands; returns the failures, if any."""
+    # Scopes are independent, so clear the user scopes and set per-admin commands concurrently
+    jobs = [
+        ("default user commands", _clear_commands(bot, BotCommandScopeDefault())),
+        ("private chat commands", _clear_commands(bot, BotCommandScopeAllPrivateChats())),
+    ] + [
+        (f"admin commands for {aid}", bot.set_my_commands(_ADMIN_CMDS, scope=BotCommandScopeChat(aid)))
+        for aid in _admin_int_ids
+    ]
+    results = await asyncio.gather(*(job for _, job in jobs), return_exceptions=True)
+    failed = []
+    for (what, _), res in zip(jobs, results):
+        if isinstance(res, Exception):
+            logger.error("Error setting %s: %s", what, res)
+            failed.append(f"{what}: {res}")
+    return failed
+
+
+async def _post_init(app: Application):
+    await _sync_commands(app.bot)
 
 
 async def users_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to open users overview list with pagination and details."""
-    uid = str(update.effective_user.id)
-    if not is_admin(uid):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     # Build and send first overview page
     try:
-        # Reuse internal builder by calling the same DB queries here
-        criteria = {"role": {"$ne": "admin"}}
-        total = um.db.users.count_documents(criteria)
-        cursor = (
-            um.db.users.find(criteria, {"user_id": 1, "username": 1, "first_name": 1, "status": 1, "subscription_expires": 1, "date_added": 1})
-            .sort("date_added", -1)
-            .limit(PAGE_SIZE)
-        )
-        users = list(cursor)
-        rows: List[List[InlineKeyboardButton]] = []
-        def _status_emoji(u: Dict[str, Any]) -> str:
-            s = u.get("status")
-            if s == "active":
-                return "✅"
-            if s == "pending":
-                return "⏳"
-            if s == "banned":
-                return "⛔"
-            return "⚪"
-        for u in users:
-            label_base = u.get("username") or u.get("first_name") or u.get("user_id")
-            label = f"{_status_emoji(u)} {label_base} ({u.get('user_id')})"
-            rows.append([
-                InlineKeyboardButton("ℹ️ Деталі", callback_data=f"user_info:{u.get('user_id')}"),
-                InlineKeyboardButton(label, callback_data=f"noop:{u.get('user_id')}")
-            ])
-        nav: List[InlineKeyboardButton] = []
-        if total > PAGE_SIZE:
-            nav.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"admin_users_page:1"))
-        if nav:
-            rows.append(nav)
-        rows.append([InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")])
-        text = (
-            "Список користувачів (перегляд деталей/посилань).\n"
-            f"Сторінка 1, усього користувачів: {total}"
-        )
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(rows))
+        text, kb = await asyncio.to_thread(_render_users_page, 0, "info")
+        await update.message.reply_text(text, reply_markup=kb)
     except Exception as e:
         await update.message.reply_text(f"Помилка: {e}")
 
 
 # ---- User Setup Request Conversation ----
+_SETUP_KEY = "_setup"
+_ADMIN_NOTIFY_CONCURRENCY = 5
+
+
+def _setup_state(context: ContextTypes.DEFAULT_TYPE, **start) -> Dict[str, Any]:
+    """The setup conversation's state (lang, uid, from_menu, city, price). It lives under one
+    user_data key so finishing or cancelling drops it at once; passing fields starts afresh."""
+    if start:
+        context.user_data[_SETUP_KEY] = start
+    return context.user_data.setdefault(_SETUP_KEY, {})
+
+
 async def user_setup_city_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle city input from user."""
     city = (update.message.text or "").strip()
-    user_lang = context.user_data.get("setup_user_lang", "uk")
+    setup = _setup_state(context)
+    user_lang = setup.get("lang", "uk")
     
     if not city:
         await update.message.reply_text(get_text("setup_ask_city", user_lang))
         return USER_SETUP_ASK_CITY
     
     # Store city
-    context.user_data["setup_city"] = city
+    setup["city"] = city
     
     # Ask for price
-    cancel_kb = InlineKeyboardMarkup([[InlineKeyboardButton(get_text("btn_back_menu", user_lang), callback_data="user_setup_cancel")]])
+    cancel_kb = _setup_cancel_keyboard(user_lang)
     await update.message.reply_text(
         get_text("setup_ask_price", user_lang),
         reply_markup=cancel_kb
@@ -823,17 +1001,18 @@ async def user_setup_city_msg(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def user_setup_price_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle price input from user."""
     price = (update.message.text or "").strip()
-    user_lang = context.user_data.get("setup_user_lang", "uk")
+    setup = _setup_state(context)
+    user_lang = setup.get("lang", "uk")
     
     if not price:
         await update.message.reply_text(get_text("setup_ask_price", user_lang))
         return USER_SETUP_ASK_PRICE
     
     # Store price
-    context.user_data["setup_price"] = price
+    setup["price"] = price
     
     # Ask for rooms
-    cancel_kb = InlineKeyboardMarkup([[InlineKeyboardButton(get_text("btn_back_menu", user_lang), callback_data="user_setup_cancel")]])
+    cancel_kb = _setup_cancel_keyboard(user_lang)
     await update.message.reply_text(
         get_text("setup_ask_rooms", user_lang),
         reply_markup=cancel_kb
@@ -845,34 +1024,27 @@ async def user_setup_price_msg(update: Update, context: ContextTypes.DEFAULT_TYP
 async def user_setup_rooms_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle rooms input from user and send setup request to admin."""
     rooms = (update.message.text or "").strip()
-    user_lang = context.user_data.get("setup_user_lang", "uk")
-    uid = context.user_data.get("setup_user_id")
+    setup = _setup_state(context)
+    user_lang = setup.get("lang", "uk")
+    uid = setup.get("uid")
     
     if not rooms:
         await update.message.reply_text(get_text("setup_ask_rooms", user_lang))
         return USER_SETUP_ASK_ROOMS
     
-    # Store rooms
-    context.user_data["setup_rooms"] = rooms
-    
     # Get all setup data
-    city = context.user_data.get("setup_city", "—")
-    price = context.user_data.get("setup_price", "—")
-    from_menu = context.user_data.get("setup_from_menu", False)
+    city = setup.get("city", "—")
+    price = setup.get("price", "—")
+    from_menu = setup.get("from_menu", False)
     
     # Store setup request in database
-    um.db.users.update_one(
-        {"user_id": uid},
-        {"$set": {
-            "setup_request": {
-                "city": city,
-                "price": price,
-                "rooms": rooms,
-                "requested_at": datetime.utcnow().isoformat(),
-                "from_menu": from_menu
-            }
-        }}
-    )
+    await asyncio.to_thread(um.set_setup_request, uid, {
+        "city": city,
+        "price": price,
+        "rooms": rooms,
+        "requested_at": datetime.utcnow().isoformat(),
+        "from_menu": from_menu
+    })
     
     # Send confirmation to user
     await update.message.reply_text(
@@ -881,7 +1053,7 @@ async def user_setup_rooms_msg(update: Update, context: ContextTypes.DEFAULT_TYP
     )
     
     # Send notification to admins with inline buttons
-    if _admin_ids:
+    if _admin_int_ids:
         u = update.effective_user
         username = f"@{u.username}" if u.username else u.first_name or "—"
         
@@ -903,23 +1075,22 @@ async def user_setup_rooms_msg(update: Update, context: ContextTypes.DEFAULT_TYP
             [InlineKeyboardButton("➕ Додати посилання", callback_data=f"admin_quick_add_links:{uid}")],
         ])
         
-        for aid in _admin_ids:
-            try:
-                await context.bot.send_message(
-                    chat_id=aid, 
-                    text=admin_text,
-                    reply_markup=admin_kb
-                )
-            except Exception as e:
-                print(f"Failed to notify admin {aid}: {e}")
+        # Notify all admins concurrently; a small local cap instead of the broadcast bucket so
+        # this user-facing handler never queues behind a running broadcast
+        sem = asyncio.Semaphore(_ADMIN_NOTIFY_CONCURRENCY)
+
+        async def _notify(aid: int):
+            async with sem:
+                await context.bot.send_message(chat_id=aid, text=admin_text, reply_markup=admin_kb)
+
+        admins = list(_admin_int_ids)
+        results = await asyncio.gather(*(_notify(aid) for aid in admins), return_exceptions=True)
+        for aid, res in zip(admins, results):
+            if isinstance(res, Exception):
+                logger.warning("Failed to notify admin %s: %s", aid, res)
     
     # Clear context
-    context.user_data.pop("setup_user_lang", None)
-    context.user_data.pop("setup_user_id", None)
-    context.user_data.pop("setup_city", None)
-    context.user_data.pop("setup_price", None)
-    context.user_data.pop("setup_rooms", None)
-    context.user_data.pop("setup_from_menu", None)
+    context.user_data.pop(_SETUP_KEY, None)
     
     return ConversationHandler.END
 
@@ -929,16 +1100,11 @@ async def user_setup_cancel_cb(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     
-    uid = str(query.from_user.id)
+    uid = context.user_data["uid"]
     user_lang = um.get_user_language(uid)
     
     # Clear context
-    context.user_data.pop("setup_user_lang", None)
-    context.user_data.pop("setup_user_id", None)
-    context.user_data.pop("setup_city", None)
-    context.user_data.pop("setup_price", None)
-    context.user_data.pop("setup_rooms", None)
-    context.user_data.pop("setup_from_menu", None)
+    context.user_data.pop(_SETUP_KEY, None)
     
     # Return to menu
     welcome_text = get_text("welcome_text", user_lang)
@@ -1005,46 +1171,96 @@ def _user_setup_conv() -> ConversationHandler:
     )
 
 
+async def _uid_middleware(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before every handler: expose the caller's id as a string in user_data["uid"]
+    and invalidate the tracked menu snapshot a callback may be about to edit."""
+    if update.effective_user:
+        context.user_data["uid"] = str(update.effective_user.id)
+        # Callback handlers edit the message their button sits on, which may be the tracked menu
+        query = update.callback_query
+        if query and query.message:
+            _forget_menu_content(context.user_data["uid"], query.message.message_id)
+
+
+def _setup_queue_logging():
+    """Hand log records to a queue so the stream writes happen on a background listener thread.
+    QueueHandler.prepare() still formats each record in the calling thread."""
+    root = logging.getLogger()
+    if any(isinstance(h, QueueHandler) for h in root.handlers):
+        return
+    handlers = root.handlers or [logging.StreamHandler()]
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(q, *handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(q)]
+    listener.start()
+    atexit.register(listener.stop)
+
+
 def build_app():
     from telegram.ext import JobQueue
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(_post_init).job_queue(JobQueue()).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("menu", menu_cmd))
-    app.add_handler(CommandHandler("support", support_cmd))
-    app.add_handler(CommandHandler("status", status_cmd))
-    app.add_handler(CommandHandler("users", users_cmd))
-    app.add_handler(CommandHandler("admin", admin_menu))
-    app.add_handler(CommandHandler("approve", approve))
-    app.add_handler(CommandHandler("delete_user", delete_user))
-    app.add_handler(CommandHandler("set_location", set_location))
-    app.add_handler(CommandHandler("view_location", view_location))
-    app.add_handler(CommandHandler("assign_links", assign_links))
-    app.add_handler(CommandHandler("add_link", assign_links))  # Alias for easier use
-    app.add_handler(CommandHandler("reply_assign", reply_assign))
-    app.add_handler(CommandHandler("set_links", set_links))
-    app.add_handler(CommandHandler("test_run", test_run))
-    app.add_handler(CommandHandler("force_run", force_run_cmd))
-    app.add_handler(CommandHandler("broadcast", broadcast))
-    app.add_handler(CommandHandler("refresh_commands", refresh_commands))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("push_menu", push_menu_cmd))
+    _setup_queue_logging()
+    # Messages are mostly listing links: Telegram would otherwise fetch a preview for every send
+    defaults = Defaults(link_preview_options=LinkPreviewOptions(is_disabled=True))
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .defaults(defaults)
+        .connection_pool_size(TELEGRAM_CONNECTION_POOL_SIZE)
+        .pool_timeout(TELEGRAM_POOL_TIMEOUT)
+        .connect_timeout(TELEGRAM_CONNECT_TIMEOUT)
+        .read_timeout(TELEGRAM_READ_TIMEOUT)
+        .post_init(_post_init)
+        .job_queue(JobQueue())
+        .build()
+    )
+    # Long-running admin commands (DB scans, Telegram fan-out, parsing) use block=False so they
+    # don't hold up other users' updates; everything else stays sequential to keep per-user
+    # conversation state consistent
+    app.add_handler(TypeHandler(Update, _uid_middleware), group=-1)
+    # (command, callback, block)
+    commands = (
+        ("start", start, True),
+        ("menu", menu_cmd, True),
+        ("support", support_cmd, True),
+        ("status", status_cmd, True),
+        ("users", users_cmd, False),
+        ("admin", admin_menu, True),
+        ("approve", approve, True),
+        ("delete_user", delete_user, True),
+        ("set_location", set_location, True),
+        ("view_location", view_location, True),
+        ("assign_links", assign_links, True),
+        ("add_link", assign_links, True),  # Alias for easier use
+        ("reply_assign", reply_assign, True),
+        ("set_links", set_links, True),
+        ("test_run", test_run, False),
+        ("force_run", force_run_cmd, False),
+        ("broadcast", broadcast, False),
+        ("refresh_commands", refresh_commands, False),
+        ("help", help_cmd, True),
+        ("push_menu", push_menu_cmd, False),
+    )
+    for name, callback, block in commands:
+        app.add_handler(CommandHandler(name, callback, block=block))
     # Reply keyboard single-button 'Menu' text handler: restrict to exact button labels to avoid blocking other text flows
     app.add_handler(MessageHandler(filters.Regex(r'^(Меню|Menu|القائمة)$'), menu_text_handler))
     
     # User menu callbacks - MUST be registered BEFORE ConversationHandler to avoid being captured
     # NOTE: user_subscribe_cb and user_add_cities_cb are handled by user setup conversation, so NOT registered here
-    app.add_handler(CallbackQueryHandler(language_selection_cb, pattern=r"^lang_(uk|ru|ar)$"))
-    app.add_handler(CallbackQueryHandler(user_change_lang_cb, pattern=r"^user_change_lang$"))
-    app.add_handler(CallbackQueryHandler(user_support_cb, pattern=r"^user_support$"))
-    app.add_handler(CallbackQueryHandler(user_sub_info_cb, pattern=r"^user_sub_info$"))
-    app.add_handler(CallbackQueryHandler(user_back_menu_cb, pattern=r"^user_back_menu$"))
-    
-    # Admin inline approve/decline from user subscribe request
-    app.add_handler(CallbackQueryHandler(admin_inline_approve_cb, pattern=r"^admin_inline_approve:"))
-    app.add_handler(CallbackQueryHandler(admin_inline_decline_cb, pattern=r"^admin_inline_decline:"))
-    
-    # Quick assign callbacks for new /assign_links and /reply_assign commands
-    app.add_handler(CallbackQueryHandler(quick_assign_mode_cb, pattern=r"^quick_assign_(trial|subscription|cancel)$"))
+    callbacks = (
+        (language_selection_cb, r"^lang_(uk|ru|ar)$"),
+        (user_change_lang_cb, r"^user_change_lang$"),
+        (user_support_cb, r"^user_support$"),
+        (user_sub_info_cb, r"^user_sub_info$"),
+        (user_back_menu_cb, r"^user_back_menu$"),
+        # Admin inline approve/decline from user subscribe request
+        (admin_inline_approve_cb, r"^admin_inline_approve:"),
+        (admin_inline_decline_cb, r"^admin_inline_decline:"),
+        # Quick assign callbacks for new /assign_links and /reply_assign commands
+        (quick_assign_mode_cb, r"^quick_assign_(trial|subscription|cancel)$"),
+    )
+    for callback, pattern in callbacks:
+        app.add_handler(CallbackQueryHandler(callback, pattern=pattern))
     
     # Quick add links conversation from setup request notification
     app.add_handler(_admin_quick_add_links_conv())
@@ -1070,171 +1286,235 @@ USER_SETUP_ASK_CITY, USER_SETUP_ASK_PRICE, USER_SETUP_ASK_ROOMS = range(9, 12)
 
 # Pagination size for admin user list
 PAGE_SIZE = 10
+# Fields needed to render a user-picker button
+_PICKER_FIELDS = {"_id": 0, "user_id": 1, "username": 1, "first_name": 1}
+_STATUS_EXPIRES_INDEX = "status_subexp_label_cover"
+
+
+_ADMIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👥 Користувачі та посилання", callback_data="admin_users")],
+    [InlineKeyboardButton("🔔 Користувачі без активації", callback_data="admin_not_activated")],
+    [InlineKeyboardButton("➕ Додати посилання користувачу", callback_data="admin_add_links")],
+    [InlineKeyboardButton("💳 Підтвердити оплату", callback_data="admin_paid")],
+    [InlineKeyboardButton("❎ Скасувати підписку", callback_data="admin_cancel_sub")],
+    [InlineKeyboardButton("📣 Розсилка повідомлення", callback_data="admin_broadcast")],
+    [InlineKeyboardButton("🗑 Видалити користувача", callback_data="admin_delete")],
+    [InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")],
+])
+
+# Static admin keyboards, built once and reused by every handler
+_KB_CANCEL = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")]])
+_KB_MODE = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🧪 Тест (14 днів)", callback_data="mode_trial"), InlineKeyboardButton("💳 Підписка (30 днів)", callback_data="mode_subscription")],
+    [InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")],
+])
+_KB_BACK_TO_MENU = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="admin_menu_back")]])
+_KB_BACK_TO_USERS = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="admin_users")]])
+_KB_QUICK_ADD_CANCEL = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="quick_add_cancel")]])
+_QUICK_ASSIGN_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🧪 Тест (14 днів)", callback_data="quick_assign_trial"),
+        InlineKeyboardButton("💳 Підписка (30 днів)", callback_data="quick_assign_subscription")
+    ],
+    [InlineKeyboardButton("❌ Скасувати", callback_data="quick_assign_cancel")]
+])
+_QUICK_ADD_MODE_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🧪 Тест (14 днів)", callback_data="quick_add_mode_trial"),
+        InlineKeyboardButton("💳 Підписка (30 днів)", callback_data="quick_add_mode_subscription")
+    ],
+    [InlineKeyboardButton("❌ Скасувати", callback_data="quick_add_cancel")]
+])
 
 
 def _admin_menu_keyboard():
-    kb = [
-        [InlineKeyboardButton("👥 Користувачі та посилання", callback_data="admin_users")],
-        [InlineKeyboardButton("🔔 Користувачі без активації", callback_data="admin_not_activated")],
-        [InlineKeyboardButton("➕ Додати посилання користувачу", callback_data="admin_add_links")],
-        [InlineKeyboardButton("💳 Підтвердити оплату", callback_data="admin_paid")],
-        [InlineKeyboardButton("❎ Скасувати підписку", callback_data="admin_cancel_sub")],
-        [InlineKeyboardButton("📣 Розсилка повідомлення", callback_data="admin_broadcast")],
-        [InlineKeyboardButton("🗑 Видалити користувача", callback_data="admin_delete")],
-        [InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")],
-    ]
-    return InlineKeyboardMarkup(kb)
+    return _ADMIN_MENU_KB
 
 
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = str(update.effective_user.id)
-    if not is_admin(uid):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може відкривати меню.")
         return ConversationHandler.END
     await update.message.reply_text("Адмін-меню:", reply_markup=_admin_menu_keyboard())
     return ADMIN_MENU
 
 
+async def _admin_menu_users(query, context: ContextTypes.DEFAULT_TYPE):
+    # Show paginated users overview (page 0)
+    await _show_users_page(query, 0, "info")
+    return ADMIN_MENU
+
+
+async def _admin_menu_not_activated(query, context: ContextTypes.DEFAULT_TYPE):
+    # Show users who started bot but didn't activate subscription
+    users = um.get_users_started_but_not_activated()
+    if not users:
+        await query.edit_message_text(
+            "✅ Немає користувачів, які стартували бота, але не активували підписку.\n\n"
+            "Всі користувачі або активували підписку, або ще не стартували бота.",
+            reply_markup=_KB_BACK_TO_MENU
+        )
+        return ADMIN_MENU
+
+    # Format user list
+    text_lines = [
+        "🔔 Користувачі, які стартували бота, але не активували підписку:\n",
+        f"Всього: {len(users)}\n"
+    ]
+
+    from datetime import datetime as _dt
+    for u in users[:20]:  # Show first 20
+        uid = u.get("user_id")
+        username = u.get("username", "")
+        first_name = u.get("first_name", "")
+        bot_started_at = u.get("bot_started_at", "")
+
+        label = f"@{username}" if username else first_name or uid
+        try:
+            started_date = _dt.fromisoformat(bot_started_at).strftime("%d.%m.%Y")
+        except Exception:
+            started_date = "—"
+
+        text_lines.append(f"• {label} (ID: {uid}) - старт: {started_date}")
+
+    if len(users) > 20:
+        text_lines.append(f"\n... та ще {len(users) - 20} користувачів")
+
+    text_lines.append(
+        "\n💡 Використайте /broadcast для надсилання повідомлення всім користувачам "
+        "або додайте посилання окремим користувачам."
+    )
+
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📣 Розсилка цим користувачам", callback_data="admin_broadcast_not_activated")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="admin_menu_back")]
+    ])
+    await query.edit_message_text("\n".join(text_lines), reply_markup=kb)
+    return ADMIN_MENU
+
+
+async def _admin_menu_add_links(query, context: ContextTypes.DEFAULT_TYPE):
+    # Show paginated list of users for selection (page 0)
+    await _show_users_page(query, 0)
+    # Ensure search mode is off by default
+    context.user_data.pop("awaiting_user_search", None)
+    return CHOOSE_USER
+
+
+async def _admin_menu_broadcast(query, context: ContextTypes.DEFAULT_TYPE):
+    # Ask admin to enter the broadcast message text
+    kb = _KB_CANCEL
+    await query.edit_message_text(
+        "Надішліть текст повідомлення для розсилки всім користувачам.",
+        reply_markup=kb,
+    )
+    return BROADCAST_ENTER
+
+
+async def _admin_menu_cancel_sub(query, context: ContextTypes.DEFAULT_TYPE):
+    # List users with an active subscription
+    now_iso = _now_iso()
+    criteria = {
+        "status": "active",
+        "subscription_expires": {"$gt": now_iso},
+    }
+
+    def _find_active() -> List[Dict[str, Any]]:
+        try:
+            return list(um.db.users.find(criteria, _PICKER_FIELDS).hint(_STATUS_EXPIRES_INDEX).limit(25))
+        except OperationFailure:
+            # Index missing (creation is best-effort at startup): let the planner choose
+            return list(um.db.users.find(criteria, _PICKER_FIELDS).limit(25))
+
+    users = await asyncio.to_thread(_find_active)
+    if not users:
+        await query.edit_message_text("Немає користувачів з активною підпискою.")
+        return ConversationHandler.END
+    rows = []
+    for u in users:
+        label = u.get("username") or u.get("first_name") or u.get("user_id")
+        rows.append([InlineKeyboardButton(f"Скасувати: {label} ({u['user_id']})", callback_data=f"cancel_sub:{u['user_id']}")])
+    rows.append([InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")])
+    await query.edit_message_text("Оберіть користувача для скасування підписки:", reply_markup=InlineKeyboardMarkup(rows))
+    return CHOOSE_USER
+
+
+async def _admin_menu_paid(query, context: ContextTypes.DEFAULT_TYPE):
+    # List users awaiting payment or without active subscription
+    now_iso = _now_iso()
+    criteria = {
+        "$or": [
+            {"awaiting_payment": True},
+            {"subscription_expires": None},
+            {"subscription_expires": {"$lt": now_iso}},
+        ],
+        "status": {"$ne": "banned"},
+    }
+
+    def _find_unpaid() -> List[Dict[str, Any]]:
+        return list(um.db.users.find(criteria, _PICKER_FIELDS).limit(20))
+
+    users = await asyncio.to_thread(_find_unpaid)
+    if not users:
+        await query.edit_message_text("Немає користувачів, які очікують оплати.")
+        return ConversationHandler.END
+    rows = []
+    for u in users:
+        label = u.get("username") or u.get("first_name") or u.get("user_id")
+        rows.append([InlineKeyboardButton(f"Оплата: {label} ({u['user_id']})", callback_data=f"mark_paid:{u['user_id']}")])
+    rows.append([InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")])
+    await query.edit_message_text("Оберіть користувача для активації підписки (оплата отримана):", reply_markup=InlineKeyboardMarkup(rows))
+    return CHOOSE_USER_PAID
+
+
+async def _admin_menu_delete(query, context: ContextTypes.DEFAULT_TYPE):
+    # Show delete users page with search option
+    await _show_users_page(query, 0, "delete")
+    # Ensure search mode is off by default
+    context.user_data.pop("awaiting_user_delete_search", None)
+    return CONFIRM_DELETE
+
+
+async def _admin_menu_cancel(query, context: ContextTypes.DEFAULT_TYPE):
+    await query.edit_message_text("Скасовано.")
+    return ConversationHandler.END
+
+
+# Admin menu buttons -> handler; the same pattern is used for every registration below
+_ADMIN_MENU_ACTIONS = {
+    "admin_users": _admin_menu_users,
+    "admin_not_activated": _admin_menu_not_activated,
+    "admin_add_links": _admin_menu_add_links,
+    "admin_broadcast": _admin_menu_broadcast,
+    "admin_cancel_sub": _admin_menu_cancel_sub,
+    "admin_paid": _admin_menu_paid,
+    "admin_delete": _admin_menu_delete,
+    "admin_cancel": _admin_menu_cancel,
+}
+_ADMIN_MENU_PATTERN = r"^admin_(add_links|broadcast|delete|cancel|paid|cancel_sub|users|not_activated)$"
+
+
 async def admin_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = query.data
-    uid = str(update.effective_user.id)
-    if not is_admin(uid):
+    if not is_admin(update.effective_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return ConversationHandler.END
-    if data == "admin_users":
-        # Show paginated users overview (page 0)
-        await _show_users_overview_page(query, page=0)
-        return ADMIN_MENU
-    elif data == "admin_not_activated":
-        # Show users who started bot but didn't activate subscription
-        users = um.get_users_started_but_not_activated()
-        if not users:
-            await query.edit_message_text(
-                "✅ Немає користувачів, які стартували бота, але не активували підписку.\n\n"
-                "Всі користувачі або активували підписку, або ще не стартували бота.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="admin_menu_back")]])
-            )
-            return ADMIN_MENU
-        
-        # Format user list
-        text_lines = [
-            "🔔 Користувачі, які стартували бота, але не активували підписку:\n",
-            f"Всього: {len(users)}\n"
-        ]
-        
-        from datetime import datetime as _dt
-        for u in users[:20]:  # Show first 20
-            uid = u.get("user_id")
-            username = u.get("username", "")
-            first_name = u.get("first_name", "")
-            bot_started_at = u.get("bot_started_at", "")
-            
-            label = f"@{username}" if username else first_name or uid
-            try:
-                started_date = _dt.fromisoformat(bot_started_at).strftime("%d.%m.%Y")
-            except Exception:
-                started_date = "—"
-            
-            text_lines.append(f"• {label} (ID: {uid}) - старт: {started_date}")
-        
-        if len(users) > 20:
-            text_lines.append(f"\n... та ще {len(users) - 20} користувачів")
-        
-        text_lines.append(
-            "\n💡 Використайте /broadcast для надсилання повідомлення всім користувачам "
-            "або додайте посилання окремим користувачам."
-        )
-        
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📣 Розсилка цим користувачам", callback_data="admin_broadcast_not_activated")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="admin_menu_back")]
-        ])
-        await query.edit_message_text("\n".join(text_lines), reply_markup=kb)
-        return ADMIN_MENU
-    if data == "admin_add_links":
-        # Show paginated list of users for selection (page 0)
-        await _show_users_page(query, page=0)
-        # Ensure search mode is off by default
-        context.user_data.pop("awaiting_user_search", None)
-        return CHOOSE_USER
-    elif data == "admin_broadcast":
-        # Ask admin to enter the broadcast message text
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")]])
-        await query.edit_message_text(
-            "Надішліть текст повідомлення для розсилки всім користувачам.",
-            reply_markup=kb,
-        )
-        return BROADCAST_ENTER
-    elif data == "admin_cancel_sub":
-        # List users with an active subscription
-        now_iso = datetime.utcnow().isoformat()
-        criteria = {
-            "status": "active",
-            "subscription_expires": {"$gt": now_iso},
-        }
-        users = list(um.db.users.find(criteria, {"user_id": 1, "username": 1, "first_name": 1}).limit(25))
-        if not users:
-            await query.edit_message_text("Немає користувачів з активною підпискою.")
-            return ConversationHandler.END
-        rows = []
-        for u in users:
-            label = u.get("username") or u.get("first_name") or u.get("user_id")
-            rows.append([InlineKeyboardButton(f"Скасувати: {label} ({u['user_id']})", callback_data=f"cancel_sub:{u['user_id']}")])
-        rows.append([InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")])
-        await query.edit_message_text("Оберіть користувача для скасування підписки:", reply_markup=InlineKeyboardMarkup(rows))
-        return CHOOSE_USER
-    elif data == "admin_paid":
-        # List users awaiting payment or without active subscription
-        now_iso = datetime.utcnow().isoformat()
-        criteria = {
-            "$or": [
-                {"awaiting_payment": True},
-                {"subscription_expires": None},
-                {"subscription_expires": {"$lt": now_iso}},
-            ],
-            "status": {"$ne": "banned"},
-        }
-        users = list(um.db.users.find(criteria, {"user_id": 1, "username": 1, "first_name": 1}).limit(20))
-        if not users:
-            await query.edit_message_text("Немає користувачів, які очікують оплати.")
-            return ConversationHandler.END
-        rows = []
-        for u in users:
-            label = u.get("username") or u.get("first_name") or u.get("user_id")
-            rows.append([InlineKeyboardButton(f"Оплата: {label} ({u['user_id']})", callback_data=f"mark_paid:{u['user_id']}")])
-        rows.append([InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")])
-        await query.edit_message_text("Оберіть користувача для активації підписки (оплата отримана):", reply_markup=InlineKeyboardMarkup(rows))
-        return CHOOSE_USER_PAID
-    elif data == "admin_delete":
-        # Show delete users page with search option
-        await _show_delete_users_page(query, page=0)
-        # Ensure search mode is off by default
-        context.user_data.pop("awaiting_user_delete_search", None)
-        return CONFIRM_DELETE
-    elif data == "admin_cancel":
-        await query.edit_message_text("Скасовано.")
-        return ConversationHandler.END
-    else:
+    action = _ADMIN_MENU_ACTIONS.get(query.data)
+    if action is None:
         await query.edit_message_text("Невідома дія.")
         return ConversationHandler.END
+    return await action(query, context)
 
 
 async def pick_user_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = query.data
-    if not data.startswith("pick_user:"):
-        await query.edit_message_text("Помилка вибору користувача.")
-        return ConversationHandler.END
-    target_id = data.split(":", 1)[1]
+    # The handler pattern guarantees the prefix
+    target_id = query.data[len("pick_user:"):]
     context.user_data["target_user_id"] = target_id
     # Ask for assignment mode: trial vs subscription
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🧪 Тест (14 днів)", callback_data="mode_trial"), InlineKeyboardButton("💳 Підписка (30 днів)", callback_data="mode_subscription")],
-        [InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")],
-    ])
+    kb = _KB_MODE
     await query.edit_message_text(
         f"Користувача {target_id} обрано. Оберіть режим призначення посилань:",
         reply_markup=kb,
@@ -1242,167 +1522,85 @@ async def pick_user_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return CHOOSE_MODE
 
 
-async def _show_users_page(query, page: int):
-    """Render a page with users for admin selection."""
-    try:
-        # Exclude admins from the list
-        criteria = {"role": {"$ne": "admin"}}
-        total = um.db.users.count_documents(criteria)
-        skip = max(0, page) * PAGE_SIZE
-        cursor = (
-            um.db.users.find(criteria, {"user_id": 1, "username": 1, "first_name": 1, "status": 1, "subscription_expires": 1, "date_added": 1})
-            .sort("date_added", -1)
-            .skip(skip)
-            .limit(PAGE_SIZE)
-        )
-        users = list(cursor)
-        rows: List[List[InlineKeyboardButton]] = []
-        # Map status to icons for quick scan
-        def _status_emoji(u: Dict[str, Any]) -> str:
-            s = u.get("status")
-            if s == "active":
-                return "✅"
-            if s == "pending":
-                return "⏳"
-            if s == "banned":
-                return "⛔"
-            return "⚪"
-        for u in users:
-            label_base = u.get("username") or u.get("first_name") or u.get("user_id")
-            label = f"{_status_emoji(u)} {label_base} ({u.get('user_id')})"
-            rows.append([
-                InlineKeyboardButton(label, callback_data=f"pick_user:{u.get('user_id')}")
-            ])
-        # Navigation row
-        nav: List[InlineKeyboardButton] = []
-        if page > 0:
-            nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"admin_list_users:{page-1}"))
-        if (page + 1) * PAGE_SIZE < total:
-            nav.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"admin_list_users:{page+1}"))
-        if nav:
-            rows.append(nav)
-        # Search button
-        rows.append([InlineKeyboardButton("🔍 Пошук за ID або @username", callback_data="admin_search_user")])
-        # Cancel
-        rows.append([InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")])
-        text = (
-            "Оберіть користувача зі списку або використайте пошук.\n"
-            f"Сторінка {page+1}, усього користувачів: {total}"
-        )
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(rows))
-    except Exception as e:
-        try:
-            await query.edit_message_text(f"Помилка завантаження списку користувачів: {e}")
-        except Exception:
-            pass
+# Status icons for quick scanning of the user list
+_STATUS_EMOJI: Dict[str, str] = {"active": "✅", "pending": "⏳", "banned": "⛔"}
 
 
-async def _show_users_overview_page(query, page: int):
-    """Render a page with users for overview (with details buttons)."""
-    try:
-        criteria = {"role": {"$ne": "admin"}}
-        total = um.db.users.count_documents(criteria)
-        skip = max(0, page) * PAGE_SIZE
-        cursor = (
-            um.db.users.find(criteria, {"user_id": 1, "username": 1, "first_name": 1, "status": 1, "subscription_expires": 1, "date_added": 1})
-            .sort("date_added", -1)
-            .skip(skip)
-            .limit(PAGE_SIZE)
-        )
-        users = list(cursor)
-        rows: List[List[InlineKeyboardButton]] = []
-        def _status_emoji(u: Dict[str, Any]) -> str:
-            s = u.get("status")
-            if s == "active":
-                return "✅"
-            if s == "pending":
-                return "⏳"
-            if s == "banned":
-                return "⛔"
-            return "⚪"
-        for u in users:
-            label_base = u.get("username") or u.get("first_name") or u.get("user_id")
-            label = f"{_status_emoji(u)} {label_base} ({u.get('user_id')})"
-            rows.append([
-                InlineKeyboardButton("ℹ️ Деталі", callback_data=f"user_info:{u.get('user_id')}"),
-                InlineKeyboardButton(label, callback_data=f"noop:{u.get('user_id')}")
-            ])
-        nav: List[InlineKeyboardButton] = []
-        if page > 0:
-            nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"admin_users_page:{page-1}"))
-        if (page + 1) * PAGE_SIZE < total:
-            nav.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"admin_users_page:{page+1}"))
-        if nav:
-            rows.append(nav)
-        rows.append([InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")])
-        text = (
-            "Список користувачів (перегляд деталей/посилань).\n"
-            f"Сторінка {page+1}, усього користувачів: {total}"
-        )
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(rows))
-    except Exception as e:
-        try:
-            await query.edit_message_text(f"Помилка завантаження: {e}")
-        except Exception:
-            pass
+def _user_label(u: Dict[str, Any]) -> str:
+    label_base = u.get("display_label") or u.get("username") or u.get("first_name") or u.get("user_id")
+    return f"{_STATUS_EMOJI.get(u.get('status'), '⚪')} {label_base} ({u.get('user_id')})"
 
 
-async def _show_delete_users_page(query, page: int):
-    """Render a page with users for deletion selection."""
-    try:
-        criteria = {"role": {"$ne": "admin"}}
-        total = um.db.users.count_documents(criteria)
-        skip = max(0, page) * PAGE_SIZE
-        cursor = (
-            um.db.users.find(criteria, {"user_id": 1, "username": 1, "first_name": 1, "status": 1, "subscription_expires": 1, "date_added": 1})
-            .sort("date_added", -1)
-            .skip(skip)
-            .limit(PAGE_SIZE)
-        )
-        users = list(cursor)
-        rows: List[List[InlineKeyboardButton]] = []
-        
-        def _status_emoji(u: Dict[str, Any]) -> str:
-            s = u.get("status")
-            if s == "active":
-                return "✅"
-            if s == "pending":
-                return "⏳"
-            if s == "banned":
-                return "⛔"
-            return "⚪"
-        
-        for u in users:
-            label_base = u.get("username") or u.get("first_name") or u.get("user_id")
-            label = f"{_status_emoji(u)} {label_base} ({u.get('user_id')})"
-            rows.append([
-                InlineKeyboardButton(f"🗑 {label}", callback_data=f"del_user:{u.get('user_id')}")
-            ])
-        
-        # Navigation row
-        nav: List[InlineKeyboardButton] = []
-        if page > 0:
-            nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"admin_delete_users_page:{page-1}"))
-        if (page + 1) * PAGE_SIZE < total:
-            nav.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"admin_delete_users_page:{page+1}"))
-        if nav:
-            rows.append(nav)
-        
-        # Search button
-        rows.append([InlineKeyboardButton("🔍 Пошук за ID або @username", callback_data="admin_search_user_delete")])
-        # Cancel
-        rows.append([InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")])
-        
-        text = (
-            "🗑 Видалення користувача\n\n"
-            "Оберіть користувача зі списку або використайте пошук.\n"
-            f"Сторінка {page+1}, усього користувачів: {total}\n\n"
-            "⚠️ УВАГА: Видалення незворотне і видалить:\n"
+# Per-mode layout of the admin user list: nav callback prefix, row buttons, search callback
+# (None = no search button), header and footer text
+_USERS_PAGE_MODES: Dict[str, Dict[str, Any]] = {
+    "info": {
+        "nav": "admin_users_page",
+        "row": lambda u, label: [
+            InlineKeyboardButton("ℹ️ Деталі", callback_data=f"user_info:{u.get('user_id')}"),
+            InlineKeyboardButton(label, callback_data=f"noop:{u.get('user_id')}"),
+        ],
+        "search": None,
+        "header": "Список користувачів (перегляд деталей/посилань).\n",
+        "footer": "",
+    },
+    "pick": {
+        "nav": "admin_list_users",
+        "row": lambda u, label: [InlineKeyboardButton(label, callback_data=f"pick_user:{u.get('user_id')}")],
+        "search": "admin_search_user",
+        "header": "Оберіть користувача зі списку або використайте пошук.\n",
+        "footer": "",
+    },
+    "delete": {
+        "nav": "admin_delete_users_page",
+        "row": lambda u, label: [InlineKeyboardButton(f"🗑 {label}", callback_data=f"del_user:{u.get('user_id')}")],
+        "search": "admin_search_user_delete",
+        "header": "🗑 Видалення користувача\n\nОберіть користувача зі списку або використайте пошук.\n",
+        "footer": (
+            "\n\n⚠️ УВАГА: Видалення незворотне і видалить:\n"
             "• Дані користувача\n"
             "• Фільтри та посилання\n"
             "• Історію сповіщень"
-        )
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(rows))
+        ),
+    },
+}
+
+
+def _render_users_page(page: int, mode: str) -> tuple[str, InlineKeyboardMarkup]:
+    """Text + keyboard for one page of the admin user list in the given _USERS_PAGE_MODES mode:
+    "info" (overview with "Деталі" buttons), "pick" (link assignment) or "delete"."""
+    spec = _USERS_PAGE_MODES[mode]
+    page = max(0, page)
+    users, total = um.get_users_page(page * PAGE_SIZE, PAGE_SIZE)
+    rows: List[List[InlineKeyboardButton]] = [spec["row"](u, _user_label(u)) for u in users]
+    # Navigation row
+    nav: List[InlineKeyboardButton] = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{spec['nav']}:{page-1}"))
+    if (page + 1) * PAGE_SIZE < total:
+        nav.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"{spec['nav']}:{page+1}"))
+    if nav:
+        rows.append(nav)
+    if spec["search"]:
+        rows.append([InlineKeyboardButton("🔍 Пошук за ID або @username", callback_data=spec["search"])])
+    rows.append([InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")])
+    text = spec["header"] + f"Сторінка {page+1}, усього користувачів: {total}" + spec["footer"]
+    return text, InlineKeyboardMarkup(rows)
+
+
+async def _show_users_page(query, page: int, mode: str = "pick"):
+    """Render one page of the admin user list (see _render_users_page) into the callback message."""
+    try:
+        text, kb = await asyncio.to_thread(_render_users_page, page, mode)
+        # Only the buttons change when e.g. the list is re-opened on the same page
+        if query.message and query.message.text == text:
+            await query.edit_message_reply_markup(reply_markup=kb)
+        else:
+            await query.edit_message_text(text, reply_markup=kb)
+    except BadRequest as e:
+        # A double-tapped button re-renders the identical page; that's not an error
+        if "not modified" not in str(e).lower():
+            logger.warning("Failed to render users page %s (%s): %s", page, mode, e)
     except Exception as e:
         try:
             await query.edit_message_text(f"Помилка завантаження списку користувачів: {e}")
@@ -1434,7 +1632,7 @@ async def admin_delete_users_page_cb(update: Update, context: ContextTypes.DEFAU
         page = int(page_str)
     except Exception:
         page = 0
-    await _show_delete_users_page(query, page)
+    await _show_users_page(query, page, "delete")
     return CONFIRM_DELETE
 
 
@@ -1443,14 +1641,14 @@ async def admin_search_user_cb(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     
-    if not is_admin(str(query.from_user.id)):
+    if not is_admin(query.from_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return ConversationHandler.END
     
     # Enable search mode
     context.user_data["awaiting_user_search"] = True
     
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")]])
+    kb = _KB_CANCEL
     await query.edit_message_text(
         "🔍 Пошук користувача\n\n"
         "Надішліть ID користувача або @username для пошуку.\n\n"
@@ -1468,14 +1666,14 @@ async def admin_search_user_delete_cb(update: Update, context: ContextTypes.DEFA
     query = update.callback_query
     await query.answer()
     
-    if not is_admin(str(query.from_user.id)):
+    if not is_admin(query.from_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return ConversationHandler.END
     
     # Enable search mode for deletion
     context.user_data["awaiting_user_delete_search"] = True
     
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")]])
+    kb = _KB_CANCEL
     await query.edit_message_text(
         "🔍 Пошук користувача для видалення\n\n"
         "Надішліть ID користувача або @username для пошуку.\n\n"
@@ -1491,8 +1689,7 @@ async def admin_search_user_delete_cb(update: Update, context: ContextTypes.DEFA
 
 async def search_user_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text input when admin searches for a user by ID or username."""
-    uid = str(update.effective_user.id)
-    if not is_admin(uid):
+    if not is_admin(update.effective_user.id):
         return ConversationHandler.END
     
     # Check if we're expecting user search
@@ -1505,16 +1702,16 @@ async def search_user_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_doc = None
     if search_text.isdigit():
         # Search by user_id
-        user_doc = um.db.users.find_one({"user_id": search_text})
+        user_doc = um.get_user(search_text)
     else:
         # Search by username (case-insensitive)
-        user_doc = um.db.users.find_one({"username": {"$regex": f"^{search_text}$", "$options": "i"}})
+        user_doc = um.find_user_by_username(search_text)
     
     if not user_doc:
         await update.message.reply_text(
             f"❌ Користувача '{search_text}' не знайдено.\n\n"
             "Спробуйте ще раз або натисніть Скасувати.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")]])
+            reply_markup=_KB_CANCEL
         )
         return CHOOSE_USER
     
@@ -1527,10 +1724,7 @@ async def search_user_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     status = user_doc.get("status", "pending")
     status_text = "✅ активний" if status == "active" else "⏳ очікує" if status == "pending" else "❌ неактивний"
     
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("🧪 Тест (14 днів)", callback_data="mode_trial"), InlineKeyboardButton("💳 Підписка (30 днів)", callback_data="mode_subscription")],
-        [InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")],
-    ])
+    kb = _KB_MODE
     await update.message.reply_text(
         f"✅ Знайдено: {label} ({target_id})\nСтатус: {status_text}\n\nОберіть режим призначення посилань:",
         reply_markup=kb,
@@ -1540,8 +1734,7 @@ async def search_user_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def search_user_delete_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text input when admin searches for a user to delete by ID or username."""
-    uid = str(update.effective_user.id)
-    if not is_admin(uid):
+    if not is_admin(update.effective_user.id):
         return ConversationHandler.END
     
     # Check if we're expecting user delete search
@@ -1554,16 +1747,16 @@ async def search_user_delete_msg(update: Update, context: ContextTypes.DEFAULT_T
     user_doc = None
     if search_text.isdigit():
         # Search by user_id
-        user_doc = um.db.users.find_one({"user_id": search_text})
+        user_doc = um.get_user(search_text)
     else:
         # Search by username (case-insensitive)
-        user_doc = um.db.users.find_one({"username": {"$regex": f"^{search_text}$", "$options": "i"}})
+        user_doc = um.find_user_by_username(search_text)
     
     if not user_doc:
         await update.message.reply_text(
             f"❌ Користувача '{search_text}' не знайдено.\n\n"
             "Спробуйте ще раз або натисніть Скасувати.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")]])
+            reply_markup=_KB_CANCEL
         )
         return CONFIRM_DELETE
     
@@ -1572,7 +1765,7 @@ async def search_user_delete_msg(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text(
             "⛔ Неможливо видалити адміністратора!\n\n"
             "Спробуйте іншого користувача або натисніть Скасувати.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")]])
+            reply_markup=_KB_CANCEL
         )
         return CONFIRM_DELETE
     
@@ -1585,7 +1778,7 @@ async def search_user_delete_msg(update: Update, context: ContextTypes.DEFAULT_T
     status_text = "✅ активний" if status == "active" else "⏳ очікує" if status == "pending" else "❌ неактивний"
     
     # Get additional info
-    filters = um.get_user_filters(target_id)
+    filters = um.get_user_filters(target_id, FILTER_VIEW_FIELDS)
     links_count = len(filters.get("search_urls", [])) if filters else 0
     
     kb = InlineKeyboardMarkup([
@@ -1618,7 +1811,7 @@ async def choose_mode_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Невідомий режим.")
         return ConversationHandler.END
     context.user_data["assign_mode"] = "trial" if mode == "mode_trial" else "subscription"
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")]])
+    kb = _KB_CANCEL
     await query.edit_message_text(
         "Надішліть одним повідомленням посилання (повні URL), можна кілька через пробіл або кому.",
         reply_markup=kb,
@@ -1627,16 +1820,14 @@ async def choose_mode_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def enter_links_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = str(update.effective_user.id)
     # Ignore non-admins or when no pending target
-    if not is_admin(uid):
+    if not is_admin(update.effective_user.id):
         return ConversationHandler.END
     text = (update.message.text or "").strip()
     target_id = context.user_data.get("target_user_id")
     if not target_id:
         return ConversationHandler.END
-    import re as _re
-    links = _re.findall(r"https?://\S+", text)
+    links = list(dict.fromkeys(_URL_RE.findall(text)))
     mode = context.user_data.get("assign_mode")
     um.set_user_links(target_id, links, [], access_mode=mode)
     
@@ -1650,8 +1841,7 @@ async def enter_links_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await _send_setup_complete_notification(context, target_id, target_lang, skip_welcome=True)
     elif mode == "subscription":
         # Subscription mode: start 30-day paid subscription
-        um.mark_paid(target_id)
-        user_doc = um.db.users.find_one({"user_id": target_id}) or {}
+        user_doc = um.mark_paid(target_id)
         sub_until = user_doc.get("subscription_expires", "—")
         await update.message.reply_text(f"✅ Посилання оновлено для {target_id}.\n💳 Підписка на 30 днів активована до: {sub_until}")
         await _send_setup_complete_notification(context, target_id, target_lang, skip_welcome=True)
@@ -1660,8 +1850,7 @@ async def enter_links_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Trigger immediate parsing for this user
     # Schedule immediate asynchronous parsing for the target user
-    if context.application:
-        context.application.create_task(async_run_for_user(target_id, ignore_window=True))
+    await _request_run(update, context, target_id)
     # Clear target to end flow
     context.user_data.pop("target_user_id", None)
     context.user_data.pop("assign_mode", None)
@@ -1670,8 +1859,7 @@ async def enter_links_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def broadcast_enter_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the message input (text, video, photo, etc.) for admin broadcast flow."""
-    uid = str(update.effective_user.id)
-    if not is_admin(uid):
+    if not is_admin(update.effective_user.id):
         return ConversationHandler.END
     
     msg = update.message
@@ -1694,13 +1882,16 @@ async def broadcast_enter_msg(update: Update, context: ContextTypes.DEFAULT_TYPE
     broadcast_target = context.user_data.get("broadcast_target", "all")
     
     if broadcast_target == "not_activated":
-        users = um.get_users_started_but_not_activated()
+        user_ids = [u["user_id"] for u in um.get_users_started_but_not_activated() if u.get("user_id")]
+        total = len(user_ids)
         target_description = "користувачам без активації"
     else:
-        users = um.get_all_users_for_broadcast()
+        # Stream recipients from the DB cursor; only the total is counted up front
+        user_ids = um.iter_users_for_broadcast()
+        total = um.count_users(BROADCAST_CRITERIA)
         target_description = "всім користувачам"
     
-    if not users:
+    if not total:
         await update.message.reply_text(f"Немає користувачів для розсилки ({target_description}).")
         context.user_data.pop("broadcast_target", None)
         return ConversationHandler.END
@@ -1718,65 +1909,64 @@ async def broadcast_enter_msg(update: Update, context: ContextTypes.DEFAULT_TYPE
     if caption:
         content_type += " з підписом"
     
-    await update.message.reply_text(
-        f"📤 Починаю розсилку {target_description}: {len(users)} користувачів...\n"
+    status_msg = await update.message.reply_text(
+        f"📤 Розсилку {target_description} запущено у фоні: {total} користувачів...\n"
         f"📋 Тип контенту: {content_type}"
     )
-    success_count = 0
-    fail_count = 0
-    
-    for user in users:
-        user_id = user.get("user_id")
-        if not user_id:
-            continue
+
+    async def _send(user_id: str):
+        # Re-send the complete message by file_id (preserves text, media, caption)
+        if has_animation:
+            # Send MP4 as video with streaming support, not as GIF
+            await context.bot.send_video(
+                chat_id=user_id,
+                video=msg.animation.file_id,
+                caption=caption,
+                supports_streaming=True
+            )
+        elif has_video:
+            await context.bot.send_video(
+                chat_id=user_id,
+                video=msg.video.file_id,
+                caption=caption,
+                supports_streaming=True
+            )
+        elif has_photo:
+            await context.bot.send_photo(
+                chat_id=user_id,
+                photo=msg.photo[-1].file_id,  # Largest photo
+                caption=caption
+            )
+        elif has_document:
+            await context.bot.send_document(
+                chat_id=user_id,
+                document=msg.document.file_id,
+                caption=caption
+            )
+        elif message_text:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=message_text
+            )
+
+    async def _progress(done: int):
+        await status_msg.edit_text(f"📤 Розсилка {target_description}: надіслано {done}/{total}...")
+
+    async def _run():
+        # Runs in the background so the admin's conversation is released immediately
         try:
-            # Forward the complete message (preserves text, media, formatting)
-            if has_animation:
-                # Send MP4 as video with streaming support, not as GIF
-                await context.bot.send_video(
-                    chat_id=user_id,
-                    video=msg.animation.file_id,
-                    caption=caption,
-                    supports_streaming=True
-                )
-            elif has_video:
-                await context.bot.send_video(
-                    chat_id=user_id,
-                    video=msg.video.file_id,
-                    caption=caption,
-                    supports_streaming=True
-                )
-            elif has_photo:
-                await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=msg.photo[-1].file_id,  # Largest photo
-                    caption=caption
-                )
-            elif has_document:
-                await context.bot.send_document(
-                    chat_id=user_id,
-                    document=msg.document.file_id,
-                    caption=caption
-                )
-            elif message_text:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=message_text
-                )
-            success_count += 1
-        except Exception as e:
-            fail_count += 1
-            import traceback
-            error_details = traceback.format_exc()
-            print(f"Failed to send broadcast to {user_id}: {e}\n{error_details}")
-    
-    await update.message.reply_text(
-        f"✅ Розсилка завершена!\n"
-        f"Цільова група: {target_description}\n"
-        f"Успішно: {success_count}\n"
-        f"Помилок: {fail_count}"
-    )
-    
+            success_count, fail_count = await _send_to_all(user_ids, _send, _progress)
+            await msg.reply_text(
+                f"✅ Розсилка завершена!\n"
+                f"Цільова група: {target_description}\n"
+                f"Успішно: {success_count}\n"
+                f"Помилок: {fail_count}"
+            )
+        except Exception:
+            logger.exception("Broadcast to %s failed", target_description)
+
+    context.application.create_task(_run())
+
     # Clear broadcast target
     context.user_data.pop("broadcast_target", None)
     return ConversationHandler.END
@@ -1786,8 +1976,7 @@ async def admin_menu_back_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Handler to go back to admin menu."""
     query = update.callback_query
     await query.answer()
-    uid = str(update.effective_user.id)
-    if not is_admin(uid):
+    if not is_admin(update.effective_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return ConversationHandler.END
     await query.edit_message_text("Адмін-меню:", reply_markup=_admin_menu_keyboard())
@@ -1798,15 +1987,14 @@ async def admin_broadcast_not_activated_cb(update: Update, context: ContextTypes
     """Handler to broadcast message to users who started but didn't activate."""
     query = update.callback_query
     await query.answer()
-    uid = str(update.effective_user.id)
-    if not is_admin(uid):
+    if not is_admin(update.effective_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return ConversationHandler.END
     
     # Mark that we want to broadcast to non-activated users
     context.user_data["broadcast_target"] = "not_activated"
     
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="admin_cancel")]])
+    kb = _KB_CANCEL
     await query.edit_message_text(
         "📣 Розсилка користувачам без активації\n\n"
         "Надішліть текст повідомлення для розсилки користувачам, які стартували бота, але не активували підписку.",
@@ -1832,11 +2020,11 @@ def _admin_menu_conv() -> ConversationHandler:
         entry_points=[
             CommandHandler("admin", admin_menu),
             # Allow starting the admin conversation from inline buttons shown on /start
-            CallbackQueryHandler(admin_menu_cb, pattern=r"^admin_(add_links|broadcast|delete|cancel|paid|cancel_sub|users|not_activated)$"),
+            CallbackQueryHandler(admin_menu_cb, pattern=_ADMIN_MENU_PATTERN),
         ],
         states={
             ADMIN_MENU: [
-                CallbackQueryHandler(admin_menu_cb, pattern=r"^admin_(add_links|broadcast|delete|cancel|paid|users|not_activated)$"),
+                CallbackQueryHandler(admin_menu_cb, pattern=_ADMIN_MENU_PATTERN),
                 CallbackQueryHandler(admin_users_page_cb, pattern=r"^admin_users_page:\d+$"),
                 CallbackQueryHandler(user_info_cb, pattern=r"^user_info:.*$"),
                 CallbackQueryHandler(noop_cb, pattern=r"^noop:.*$"),
@@ -1846,7 +2034,7 @@ def _admin_menu_conv() -> ConversationHandler:
             ],
             CHOOSE_USER: [
                 CallbackQueryHandler(pick_user_cb, pattern=r"^pick_user:.*$"),
-                CallbackQueryHandler(admin_list_users_cb, pattern=r"^admin_list_users:\\d+$"),
+                CallbackQueryHandler(admin_list_users_cb, pattern=r"^admin_list_users:\d+$"),
                 CallbackQueryHandler(admin_search_user_cb, pattern=r"^admin_search_user$"),
                 CallbackQueryHandler(cancel_subscription_cb, pattern=r"^cancel_sub:.*$"),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, search_user_msg),
@@ -1882,22 +2070,26 @@ def register_global_admin_handlers(app: Application):
     # These are callback-only handlers. They don't consume text messages, so they won't
     # interfere with ConversationHandler text states. They make admin menu buttons work
     # even when shown outside the /admin conversation (e.g., from /start).
-    app.add_handler(CallbackQueryHandler(admin_menu_cb, pattern=r"^admin_(add_links|broadcast|delete|cancel|paid|cancel_sub|users|not_activated)$"))
-    app.add_handler(CallbackQueryHandler(pick_user_cb, pattern=r"^pick_user:.*$"))
-    app.add_handler(CallbackQueryHandler(admin_list_users_cb, pattern=r"^admin_list_users:\d+$"))
-    app.add_handler(CallbackQueryHandler(admin_search_user_cb, pattern=r"^admin_search_user$"))
-    app.add_handler(CallbackQueryHandler(admin_users_page_cb, pattern=r"^admin_users_page:\d+$"))
-    app.add_handler(CallbackQueryHandler(admin_delete_users_page_cb, pattern=r"^admin_delete_users_page:\d+$"))
-    app.add_handler(CallbackQueryHandler(admin_search_user_delete_cb, pattern=r"^admin_search_user_delete$"))
-    app.add_handler(CallbackQueryHandler(user_info_cb, pattern=r"^user_info:.*$"))
-    app.add_handler(CallbackQueryHandler(noop_cb, pattern=r"^noop:.*$"))
-    app.add_handler(CallbackQueryHandler(admin_menu_back_cb, pattern=r"^admin_menu_back$"))
-    app.add_handler(CallbackQueryHandler(admin_broadcast_not_activated_cb, pattern=r"^admin_broadcast_not_activated$"))
-    app.add_handler(CallbackQueryHandler(cancel_cb, pattern=r"^admin_cancel$"))
-    app.add_handler(CallbackQueryHandler(choose_mode_cb, pattern=r"^mode_(trial|subscription)$"))
-    app.add_handler(CallbackQueryHandler(confirm_delete_cb, pattern=r"^del_user:.*$"))
-    app.add_handler(CallbackQueryHandler(mark_paid_cb, pattern=r"^mark_paid:.*$"))
-    app.add_handler(CallbackQueryHandler(cancel_subscription_cb, pattern=r"^cancel_sub:.*$"))
+    callbacks = (
+        (admin_menu_cb, _ADMIN_MENU_PATTERN),
+        (pick_user_cb, r"^pick_user:.*$"),
+        (admin_list_users_cb, r"^admin_list_users:\d+$"),
+        (admin_search_user_cb, r"^admin_search_user$"),
+        (admin_users_page_cb, r"^admin_users_page:\d+$"),
+        (admin_delete_users_page_cb, r"^admin_delete_users_page:\d+$"),
+        (admin_search_user_delete_cb, r"^admin_search_user_delete$"),
+        (user_info_cb, r"^user_info:.*$"),
+        (noop_cb, r"^noop:.*$"),
+        (admin_menu_back_cb, r"^admin_menu_back$"),
+        (admin_broadcast_not_activated_cb, r"^admin_broadcast_not_activated$"),
+        (cancel_cb, r"^admin_cancel$"),
+        (choose_mode_cb, r"^mode_(trial|subscription)$"),
+        (confirm_delete_cb, r"^del_user:.*$"),
+        (mark_paid_cb, r"^mark_paid:.*$"),
+        (cancel_subscription_cb, r"^cancel_sub:.*$"),
+    )
+    for callback, pattern in callbacks:
+        app.add_handler(CallbackQueryHandler(callback, pattern=pattern))
     # Note: do NOT register any MessageHandler here.
 
 
@@ -1918,16 +2110,17 @@ async def admin_users_page_cb(update: Update, context: ContextTypes.DEFAULT_TYPE
         page = int(page_str)
     except Exception:
         page = 0
-    await _show_users_overview_page(query, page)
+    await _show_users_page(query, page, "info")
     return ADMIN_MENU
 
 
+@lru_cache(maxsize=4096)
 def _fmt_dt(iso: Any) -> str:
+    # Stored ISO dates repeat a lot while paging through users; memoize the formatting
     try:
         if not iso:
             return "—"
-        from datetime import datetime as _dt
-        return _dt.fromisoformat(str(iso)).strftime("%d.%m.%Y")
+        return datetime.fromisoformat(str(iso)).strftime("%d.%m.%Y")
     except Exception:
         return str(iso)
 
@@ -1935,17 +2128,17 @@ def _fmt_dt(iso: Any) -> str:
 async def user_info_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = query.data
-    if not data.startswith("user_info:"):
-        return ADMIN_MENU
-    uid = data.split(":", 1)[1]
+    uid = query.data[len("user_info:"):]
     try:
-        user = um.db.users.find_one({"user_id": uid}) or {}
-        f = um.get_user_filters(uid) or {}
-        links: List[str] = f.get("search_urls", []) or []
+        user, f = await asyncio.gather(
+            asyncio.to_thread(um.get_user, uid),
+            asyncio.to_thread(um.get_user_filters, uid, FILTER_PREVIEW_FIELDS),
+        )
+        f = f or {}
+        links_preview: List[str] = f.get("links_preview") or []
+        links_count: int = f.get("links_count") or 0
         cities: List[str] = f.get("preferred_locations", []) or []
-        links_preview = links[:15]
-        more = len(links) - len(links_preview)
+        more = links_count - len(links_preview)
         status = user.get("status", "—")
         text_lines = [
             f"👤 ID: {uid}",
@@ -1954,16 +2147,14 @@ async def user_info_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Активна до: {_fmt_dt(user.get('subscription_expires'))}",
             f"Дата активації: {_fmt_dt(user.get('date_activated'))}",
             f"Міст(а): {', '.join(cities) if cities else '—'}",
-            f"Посилання ({len(links)}):" if links else "Посилання: —",
+            f"Посилання ({links_count}):" if links_count else "Посилання: —",
         ]
         for url in links_preview:
             text_lines.append(f"• {url}")
         if more > 0:
             text_lines.append(f"… та ще {more} посилань")
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("⬅️ Назад", callback_data="admin_users")]
-        ])
-        await query.edit_message_text("\n".join(text_lines), reply_markup=kb, disable_web_page_preview=True)
+        kb = _KB_BACK_TO_USERS
+        await query.edit_message_text("\n".join(text_lines), reply_markup=kb)
     except Exception as e:
         try:
             await query.edit_message_text(f"Помилка: {e}")
@@ -1976,16 +2167,11 @@ async def mark_paid_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin callback to confirm payment and activate subscription for a user."""
     query = update.callback_query
     await query.answer()
-    data = query.data
-    if not data.startswith("mark_paid:"):
-        await query.edit_message_text("Помилка вибору користувача.")
-        return ConversationHandler.END
-    uid = data.split(":", 1)[1]
-    if not is_admin(str(query.from_user.id)):
+    uid = query.data[len("mark_paid:"):]
+    if not is_admin(query.from_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return ConversationHandler.END
-    um.mark_paid(uid)
-    user_doc = um.db.users.find_one({"user_id": uid}) or {}
+    user_doc = await asyncio.to_thread(um.mark_paid, uid)
     sub_until = user_doc.get("subscription_expires", "—")
     await query.edit_message_text(f"💳 Оплату підтверджено. Підписку для {uid} активовано до: {sub_until}")
     # Notify user
@@ -1997,8 +2183,7 @@ async def mark_paid_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    caller_id = str(update.effective_user.id)
-    if not is_admin(caller_id):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     if not context.args:
@@ -2018,13 +2203,10 @@ async def confirm_delete_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "admin_cancel":
         await query.edit_message_text("Скасовано.")
         return ConversationHandler.END
-    if not data.startswith("del_user:"):
-        await query.edit_message_text("Помилка вибору користувача.")
-        return ConversationHandler.END
-    target_id = data.split(":", 1)[1]
+    target_id = data[len("del_user:"):]
     
     # Get user info before deletion for confirmation message
-    user_doc = um.db.users.find_one({"user_id": target_id})
+    user_doc = um.get_user(target_id)
     if not user_doc:
         await query.edit_message_text(f"❌ Користувача {target_id} не знайдено в базі даних.")
         return ConversationHandler.END
@@ -2032,7 +2214,7 @@ async def confirm_delete_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     label = user_doc.get("username") or user_doc.get("first_name") or target_id
     
     # Get stats before deletion
-    filters = um.get_user_filters(target_id)
+    filters = um.get_user_filters(target_id, FILTER_VIEW_FIELDS)
     links_count = len(filters.get("search_urls", [])) if filters else 0
     notifications_count = um.db.notification_stats.count_documents({"recipient_id": target_id})
     
@@ -2060,34 +2242,27 @@ async def cancel_subscription_cb(update: Update, context: ContextTypes.DEFAULT_T
     """Admin callback to cancel a user's active subscription immediately."""
     query = update.callback_query
     await query.answer()
-    data = query.data
-    if not data.startswith("cancel_sub:"):
-        await query.edit_message_text("Помилка вибору користувача.")
-        return ConversationHandler.END
-    if not is_admin(str(query.from_user.id)):
+    if not is_admin(query.from_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return ConversationHandler.END
-    uid = data.split(":", 1)[1]
-    now_iso = datetime.utcnow().isoformat()
+    # cancel_sub:<uid>[,<uid>...] — several users are expired in one bulk write
+    uids = [u for u in query.data[len("cancel_sub:"):].split(",") if u]
     # Set subscription to expired and mark user inactive. Do not remove links.
-    um.db.users.update_one(
-        {"user_id": uid},
-        {"$set": {"subscription_expires": now_iso, "status": "inactive", "awaiting_payment": False},
-         "$unset": {"requested_subscription": ""}}
-    )
-    await query.edit_message_text(f"❎ Підписку користувача {uid} скасовано.")
-    # Notify the user
-    try:
-        contact = SUPPORT_CONTACT or "@admin"
-        await context.bot.send_message(
-            chat_id=uid,
-            text=(
-                "❎ Вашу підписку скасовано адміністратором.\n"
-                f"Якщо це помилка — зверніться до підтримки: {contact}"
+    await asyncio.to_thread(um.cancel_subscriptions, uids)
+    await query.edit_message_text(f"❎ Підписку користувача {', '.join(uids)} скасовано.")
+    # Notify the users
+    contact = SUPPORT_CONTACT or "@admin"
+    for uid in uids:
+        try:
+            await context.bot.send_message(
+                chat_id=uid,
+                text=(
+                    "❎ Вашу підписку скасовано адміністратором.\n"
+                    f"Якщо це помилка — зверніться до підтримки: {contact}"
+                )
             )
-        )
-    except Exception:
-        pass
+        except Exception:
+            pass
     return ConversationHandler.END
 
 
@@ -2096,7 +2271,7 @@ async def quick_assign_mode_cb(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     
-    if not is_admin(str(query.from_user.id)):
+    if not is_admin(query.from_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return
     
@@ -2137,8 +2312,7 @@ async def quick_assign_mode_cb(update: Update, context: ContextTypes.DEFAULT_TYP
     # Activate subscription based on mode
     from datetime import datetime as _dt
     if mode == "trial":
-        um.mark_trial(target_id)
-        user_doc = um.db.users.find_one({"user_id": target_id}) or {}
+        user_doc = um.mark_trial(target_id)
         sub_until = user_doc.get("subscription_expires", "—")
         try:
             sub_until_formatted = _dt.fromisoformat(sub_until).strftime("%d.%m.%Y")
@@ -2157,8 +2331,7 @@ async def quick_assign_mode_cb(update: Update, context: ContextTypes.DEFAULT_TYP
         await _send_setup_complete_notification(context, target_id, target_lang, skip_welcome=True)
     
     elif mode == "subscription":
-        um.mark_paid(target_id)
-        user_doc = um.db.users.find_one({"user_id": target_id}) or {}
+        user_doc = um.mark_paid(target_id)
         sub_until = user_doc.get("subscription_expires", "—")
         try:
             sub_until_formatted = _dt.fromisoformat(sub_until).strftime("%d.%m.%Y")
@@ -2177,8 +2350,7 @@ async def quick_assign_mode_cb(update: Update, context: ContextTypes.DEFAULT_TYP
         await _send_setup_complete_notification(context, target_id, target_lang, skip_welcome=True)
     
     # Trigger immediate parsing
-    if context.application:
-        context.application.create_task(async_run_for_user(target_id, ignore_window=True))
+    await _request_run(update, context, target_id)
     
     # Clear context
     context.user_data.pop("quick_assign_target_id", None)
@@ -2191,14 +2363,14 @@ async def user_add_cities_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     u = query.from_user
-    uid = str(u.id)
+    uid = context.user_data["uid"]
     
     try:
         # Get user's language
         user_lang = um.get_user_language(uid)
         
         # Show warning about overwriting parameters
-        cancel_kb = InlineKeyboardMarkup([[InlineKeyboardButton(get_text("btn_back_menu", user_lang), callback_data="user_setup_cancel")]])
+        cancel_kb = _setup_cancel_keyboard(user_lang)
         await context.bot.send_message(
             chat_id=uid,
             text=get_text("setup_add_cities_warning", user_lang),
@@ -2212,17 +2384,12 @@ async def user_add_cities_cb(update: Update, context: ContextTypes.DEFAULT_TYPE)
             reply_markup=cancel_kb
         )
         
-        # Store language in context for conversation
-        context.user_data["setup_user_lang"] = user_lang
-        context.user_data["setup_user_id"] = uid
-        context.user_data["setup_from_menu"] = True  # Mark that this request is from menu
+        _setup_state(context, lang=user_lang, uid=uid, from_menu=True)
         
         return USER_SETUP_ASK_CITY
         
-    except Exception as e:
-        print(f"Error starting add cities for {uid}: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Error starting add cities for %s", uid)
         return ConversationHandler.END
 
 
@@ -2231,18 +2398,18 @@ async def user_subscribe_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     u = query.from_user
-    uid = str(u.id)
+    uid = context.user_data["uid"]
     
     try:
         # Ensure user document exists (edge case: if /start didn't create it)
-        if not um.db.users.find_one({"user_id": uid}):
+        if not um.get_user(uid):
             um.upsert_user(uid, u.username or "", u.first_name or "", u.last_name or "")
         
         # Get user's language
         user_lang = um.get_user_language(uid)
         
         # Check if user already has active subscription or trial
-        user_doc = um.db.users.find_one({"user_id": uid}) or {}
+        user_doc = um.get_user(uid)
         from datetime import datetime as _dt
         now = _dt.utcnow()
         has_active = False
@@ -2275,44 +2442,33 @@ async def user_subscribe_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         um.mark_trial(uid)
         
         # Start setup conversation - ask for city
-        cancel_kb = InlineKeyboardMarkup([[InlineKeyboardButton(get_text("btn_back_menu", user_lang), callback_data="user_setup_cancel")]])
+        cancel_kb = _setup_cancel_keyboard(user_lang)
         await context.bot.send_message(
             chat_id=uid,
             text=get_text("setup_ask_city", user_lang),
             reply_markup=cancel_kb
         )
         
-        # Store language in context for conversation
-        context.user_data["setup_user_lang"] = user_lang
-        context.user_data["setup_user_id"] = uid
+        _setup_state(context, lang=user_lang, uid=uid, from_menu=False)
         
         return USER_SETUP_ASK_CITY
         
-    except Exception as e:
-        print(f"Error starting setup for {uid}: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Error starting setup for %s", uid)
         return ConversationHandler.END
 
 
 async def admin_inline_approve_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    uid = query.data.split(":", 1)[1]
-    if not is_admin(str(query.from_user.id)):
+    uid = query.data[len("admin_inline_approve:"):]
+    if not is_admin(query.from_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return
-    # Ensure user exists before approval (fallback)
-    user_doc = um.db.users.find_one({"user_id": uid})
-    if not user_doc:
-        # Create a minimal pending doc then approve
-        um.upsert_user(uid, "", "", "")
+    # Activate 14-day free trial immediately (creating a minimal user doc if it is missing)
+    user_doc = await asyncio.to_thread(um.mark_trial, uid, True)
     
-    # Activate 14-day free trial immediately
-    um.mark_trial(uid)
-    
-    # Get subscription expiration date for notification
-    user_doc = um.db.users.find_one({"user_id": uid}) or {}
+    # Subscription expiration date for notification
     sub_until = user_doc.get("subscription_expires", "—")
     from datetime import datetime as _dt
     try:
@@ -2332,20 +2488,20 @@ async def admin_inline_approve_cb(update: Update, context: ContextTypes.DEFAULT_
     except Exception:
         pass
     # Start immediate parsing for this user (if they already have links)
-    if context.application:
-        context.application.create_task(async_run_for_user(uid, ignore_window=True))
+    await _request_run(update, context, uid)
 
 
 async def admin_inline_decline_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    uid = query.data.split(":", 1)[1]
-    if not is_admin(str(query.from_user.id)):
+    uid = query.data[len("admin_inline_decline:"):]
+    if not is_admin(query.from_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return
     await query.edit_message_text(f"Заявку користувача {uid} відхилено.")
     try:
         um.db.users.update_one({"user_id": uid}, {"$unset": {"requested_subscription": ""}})
+        um.invalidate_user(uid)
         await context.bot.send_message(chat_id=uid, text="На жаль, вашу заявку відхилено. Зв'яжіться з адміністратором для уточнення.")
     except Exception:
         pass
@@ -2358,19 +2514,15 @@ async def admin_quick_add_links_cb(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     await query.answer()
     
-    if not is_admin(str(query.from_user.id)):
+    if not is_admin(query.from_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return ConversationHandler.END
     
-    # Extract user_id from callback data
-    if not query.data.startswith("admin_quick_add_links:"):
-        await query.edit_message_text("❌ Помилка: невірний формат даних.")
-        return ConversationHandler.END
-    
-    target_id = query.data.split(":", 1)[1]
+    # Extract user_id from callback data (the handler pattern guarantees the prefix)
+    target_id = query.data[len("admin_quick_add_links:"):]
     
     # Verify user exists
-    user_doc = um.db.users.find_one({"user_id": target_id})
+    user_doc = um.get_user(target_id)
     if not user_doc:
         await query.edit_message_text(f"❌ Користувача {target_id} не знайдено.")
         return ConversationHandler.END
@@ -2382,13 +2534,7 @@ async def admin_quick_add_links_cb(update: Update, context: ContextTypes.DEFAULT
     context.user_data["quick_add_label"] = label
     
     # Ask admin to choose mode: trial or subscription
-    kb = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("🧪 Тест (14 днів)", callback_data="quick_add_mode_trial"),
-            InlineKeyboardButton("💳 Підписка (30 днів)", callback_data="quick_add_mode_subscription")
-        ],
-        [InlineKeyboardButton("❌ Скасувати", callback_data="quick_add_cancel")]
-    ])
+    kb = _QUICK_ADD_MODE_KB
     
     await query.edit_message_text(
         f"📋 Призначення посилань для:\n"
@@ -2405,7 +2551,7 @@ async def admin_quick_add_mode_cb(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     await query.answer()
     
-    if not is_admin(str(query.from_user.id)):
+    if not is_admin(query.from_user.id):
         await query.edit_message_text("Лише адміністратор може виконувати цю дію.")
         return ConversationHandler.END
     
@@ -2436,7 +2582,7 @@ async def admin_quick_add_mode_cb(update: Update, context: ContextTypes.DEFAULT_
     label = context.user_data.get("quick_add_label", target_id)
     
     # Ask admin to enter links
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="quick_add_cancel")]])
+    kb = _KB_QUICK_ADD_CANCEL
     
     await query.edit_message_text(
         f"📋 Режим: {mode_text}\n"
@@ -2454,23 +2600,21 @@ async def admin_quick_add_mode_cb(update: Update, context: ContextTypes.DEFAULT_
 
 async def admin_quick_add_enter_links_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for links input in quick add links flow."""
-    uid = str(update.effective_user.id)
     
-    if not is_admin(uid):
+    if not is_admin(update.effective_user.id):
         return ConversationHandler.END
     
     # Extract links from message
     text = (update.message.text or "").strip()
     
-    import re as _re
-    links = _re.findall(r"https?://\S+", text)
+    links = list(dict.fromkeys(_URL_RE.findall(text)))
     
     if not links:
         await update.message.reply_text(
             "❌ Не знайдено жодного посилання.\n\n"
             "Переконайтеся, що ви надіслали URL (https://...).\n"
             "Спробуйте ще раз або натисніть Скасувати.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Скасувати", callback_data="quick_add_cancel")]])
+            reply_markup=_KB_QUICK_ADD_CANCEL
         )
         return QUICK_ADD_ENTER_LINKS
     
@@ -2491,17 +2635,14 @@ async def admin_quick_add_enter_links_msg(update: Update, context: ContextTypes.
     # Activate subscription based on mode
     from datetime import datetime as _dt
     if mode == "trial":
-        um.mark_trial(target_id)
-        user_doc = um.db.users.find_one({"user_id": target_id}) or {}
+        user_doc = um.mark_trial(target_id)
         sub_until = user_doc.get("subscription_expires", "—")
         try:
             sub_until_formatted = _dt.fromisoformat(sub_until).strftime("%d.%m.%Y")
         except Exception:
             sub_until_formatted = sub_until
         
-        links_preview = "\n".join([f"• {url}" for url in links[:5]])
-        if len(links) > 5:
-            links_preview += f"\n... та ще {len(links) - 5} посилань"
+        links_preview = _links_preview(links)
         
         await update.message.reply_text(
             f"✅ Посилання призначено!\n\n"
@@ -2515,17 +2656,14 @@ async def admin_quick_add_enter_links_msg(update: Update, context: ContextTypes.
         await _send_setup_complete_notification(context, target_id, target_lang, skip_welcome=True)
     
     elif mode == "subscription":
-        um.mark_paid(target_id)
-        user_doc = um.db.users.find_one({"user_id": target_id}) or {}
+        user_doc = um.mark_paid(target_id)
         sub_until = user_doc.get("subscription_expires", "—")
         try:
             sub_until_formatted = _dt.fromisoformat(sub_until).strftime("%d.%m.%Y")
         except Exception:
             sub_until_formatted = sub_until
         
-        links_preview = "\n".join([f"• {url}" for url in links[:5]])
-        if len(links) > 5:
-            links_preview += f"\n... та ще {len(links) - 5} посилань"
+        links_preview = _links_preview(links)
         
         await update.message.reply_text(
             f"✅ Посилання призначено!\n\n"
@@ -2539,8 +2677,7 @@ async def admin_quick_add_enter_links_msg(update: Update, context: ContextTypes.
         await _send_setup_complete_notification(context, target_id, target_lang, skip_welcome=True)
     
     # Trigger immediate parsing
-    if context.application:
-        context.application.create_task(async_run_for_user(target_id, ignore_window=True))
+    await _request_run(update, context, target_id)
     
     # Clear context
     context.user_data.pop("quick_add_target_id", None)
@@ -2554,7 +2691,7 @@ async def admin_quick_add_enter_links_msg(update: Update, context: ContextTypes.
 async def user_support_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    uid = str(q.from_user.id)
+    uid = context.user_data["uid"]
     user_lang = um.get_user_language(uid)
     # Import support contact from config was done at top; fallback if empty
     contact = SUPPORT_CONTACT or "@admin"
@@ -2571,45 +2708,17 @@ async def user_support_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def user_sub_info_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    uid = str(q.from_user.id)
-    user_lang = um.get_user_language(uid)
-    u = um.db.users.find_one({"user_id": uid})
-    status = (u or {}).get("status")
-    subscription_expires = (u or {}).get("subscription_expires")
-    requested = (u or {}).get("requested_subscription")
-
-    # Беремо інформацію і про триал, і про платну підписку
-    from datetime import datetime as _dt
-    now = _dt.utcnow()
-
-    def _fmt_date(iso: str) -> str:
-        try:
-            dt = _dt.fromisoformat(iso)
-            return dt.strftime("%d.%m.%Y")
-        except Exception:
-            return iso
-
-    # Спробуємо знайти активний триал у фільтрах
-    f = um.db.user_filters.find_one({"user_id": uid}) or {}
-    trial_expires = f.get("trial_expires_at")
-    trial_active = False
-    if trial_expires:
-        try:
-            trial_active = now <= _dt.fromisoformat(trial_expires)
-        except Exception:
-            trial_active = False
-
-    paid_active = False
-    if subscription_expires:
-        try:
-            paid_active = now <= _dt.fromisoformat(subscription_expires)
-        except Exception:
-            paid_active = False
-
-    if paid_active:
-        msg = get_text("sub_info_text", user_lang, date=_fmt_date(subscription_expires))
-    elif trial_active:
-        msg = get_text("sub_trial_until", user_lang, date=_fmt_date(trial_expires))
+    uid = context.user_data["uid"]
+    # PyMongo is blocking: run the lookups in a worker thread
+    u = await asyncio.to_thread(um.get_user, uid)
+    paid_until, trial_until = await asyncio.to_thread(_active_access, u, uid)
+    user_lang = u.get("language") or "uk"
+    requested = u.get("requested_subscription")
+
+    if paid_until:
+        msg = get_text("sub_info_text", user_lang, date=_fmt_dt(paid_until))
+    elif trial_until:
+        msg = get_text("sub_trial_until", user_lang, date=_fmt_dt(trial_until))
     elif requested:
         msg = get_text("sub_request_pending", user_lang)
     else:
@@ -2625,7 +2734,7 @@ async def user_back_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     try:
-        uid = str(q.from_user.id)
+        uid = context.user_data["uid"]
         user_lang = um.get_user_language(uid)
         await _ensure_user_menu(context, uid, get_text("welcome_text", user_lang))
         if uid not in _reply_kb_set:
@@ -2633,7 +2742,7 @@ async def user_back_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             rk = ReplyKeyboardMarkup([[label]], resize_keyboard=True)
             try:
                 await q.message.reply_text(get_text("menu_hint", user_lang), reply_markup=rk)
-                _reply_kb_set.add(uid)
+                _reply_kb_set[uid] = True
             except Exception:
                 pass
     except Exception:
@@ -2645,7 +2754,7 @@ async def language_selection_cb(update: Update, context: ContextTypes.DEFAULT_TY
     q = update.callback_query
     await q.answer()
     
-    uid = str(q.from_user.id)
+    uid = context.user_data["uid"]
     data = q.data
     
     # Extract language code from callback data (lang_uk, lang_ru, lang_ar)
@@ -2667,7 +2776,7 @@ async def language_selection_cb(update: Update, context: ContextTypes.DEFAULT_TY
             rk = ReplyKeyboardMarkup([[label]], resize_keyboard=True)
             try:
                 await context.bot.send_message(chat_id=uid, text=get_text("menu_hint", lang), reply_markup=rk)
-                _reply_kb_set.add(uid)
+                _reply_kb_set[uid] = True
             except Exception:
                 pass
 
@@ -2677,7 +2786,7 @@ async def user_change_lang_cb(update: Update, context: ContextTypes.DEFAULT_TYPE
     q = update.callback_query
     await q.answer()
     
-    uid = str(q.from_user.id)
+    uid = context.user_data["uid"]
     user_lang = um.get_user_language(uid)
     
     try:
@@ -2697,8 +2806,8 @@ async def user_change_lang_cb(update: Update, context: ContextTypes.DEFAULT_TYPE
 # ---- Inline Menu Utility Commands ----
 async def menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Universal command to (re)show inline menu for any user (old/new)."""
-    uid = str(update.effective_user.id)
-    if is_admin(uid):
+    uid = context.user_data["uid"]
+    if is_admin(update.effective_user.id):
         await _ensure_admin_menu(context, uid)
         return
     # Regular user: fetch language and show welcome + dynamic menu
@@ -2709,15 +2818,14 @@ async def menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         rk = ReplyKeyboardMarkup([[label]], resize_keyboard=True)
         try:
             await update.message.reply_text(get_text("menu_hint", user_lang), reply_markup=rk)
-            _reply_kb_set.add(uid)
+            _reply_kb_set[uid] = True
         except Exception:
             pass
 
 
 async def push_menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin-only: push the inline menu message to all users (existing + new)."""
-    caller_id = str(update.effective_user.id)
-    if not is_admin(caller_id):
+    if not is_admin(update.effective_user.id):
         await update.message.reply_text("Лише адміністратор може виконувати цю команду.")
         return
     users = um.get_all_users_for_broadcast()
@@ -2740,12 +2848,12 @@ async def push_menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 rk = ReplyKeyboardMarkup([[label]], resize_keyboard=True)
                 try:
                     await context.bot.send_message(chat_id=uid, text=get_text("menu_hint", lang), reply_markup=rk)
-                    _reply_kb_set.add(uid)
+                    _reply_kb_set[uid] = True
                 except Exception:
                     pass
         except Exception as e:
             failed += 1
-            print(f"Failed to push menu to {uid}: {e}")
+            logger.warning("Failed to push menu to %s: %s", uid, e)
     await update.message.reply_text(f"✅ Меню надіслано: {sent}\n❌ Помилок: {failed}")
 
 # Text-based menu button handler (reply keyboard single button)
@@ -2753,8 +2861,8 @@ async def menu_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
     if text not in ("Меню", "Menu", "القائمة"):
         return
-    uid = str(update.effective_user.id)
-    if is_admin(uid):
+    uid = context.user_data["uid"]
+    if is_admin(update.effective_user.id):
         await _ensure_admin_menu(context, uid)
         return
     user_lang = um.get_user_language(uid)
@@ -2765,6 +2873,6 @@ async def menu_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         rk = ReplyKeyboardMarkup([[label]], resize_keyboard=True)
         try:
             await update.message.reply_text(get_text("menu_hint", user_lang), reply_markup=rk)
-            _reply_kb_set.add(uid)
+            _reply_kb_set[uid] = True
         except Exception:
             pass
@@ -21,6 +21,9 @@ Language Selection Flow:
     6. User can change language anytime via menu button
 """
 
+from functools import lru_cache
+from typing import Dict
+
 TRANSLATIONS = {
     "uk": {
         # Language selection
@@ -384,6 +387,27 @@ Username: @{username}
 }
 
 
+@lru_cache(maxsize=4096)
+def _lookup(key: str, lang: str) -> str:
+    """Raw (unformatted) translation with the language/key fallbacks applied.
+    TRANSLATIONS is never mutated at runtime, so results can be memoized."""
+    # Default to Ukrainian if language not supported
+    if lang not in TRANSLATIONS:
+        lang = "uk"
+    
+    # Get translation, fallback to Ukrainian if key not found
+    return TRANSLATIONS.get(lang, {}).get(key) or TRANSLATIONS["uk"].get(key, key)
+
+
+@lru_cache(maxsize=None)
+def get_lang_dict(lang: str) -> Dict[str, str]:
+    """Flat key -> text map for a language, with the same Ukrainian fallback as get_text.
+    Treat the result as read-only; it is shared between callers."""
+    base = dict(TRANSLATIONS["uk"])
+    base.update({k: v for k, v in TRANSLATIONS.get(lang, {}).items() if v})
+    return base
+
+
 def get_text(key: str, lang: str = "uk", **kwargs) -> str:
     """
     Get translated text for the given key in the specified language.
@@ -396,12 +420,7 @@ def get_text(key: str, lang: str = "uk", **kwargs) -> str:
     Returns:
         Translated and formatted text
     """
-    # Default to Ukrainian if language not supported
-    if lang not in TRANSLATIONS:
-        lang = "uk"
-    
-    # Get translation, fallback to Ukrainian if key not found
-    text = TRANSLATIONS.get(lang, {}).get(key) or TRANSLATIONS["uk"].get(key, key)
+    text = _lookup(key, lang)
     
     # Format with provided arguments if any
     if kwargs:
@@ -1,34 +1,116 @@
 from datetime import datetime
 import pytz
-from typing import List, Dict, Any, Optional
-from .db import get_db
+from typing import List, Dict, Any, Optional, Tuple, Iterator
+from pymongo import ReturnDocument, UpdateOne
+from .db import get_db, get_client
+from .cache import TTLCache
 from .config import SUBSCRIPTION_DURATION, TRIAL_DURATION, USER_DAILY_LIMIT, NOTIFY_INTERVAL_MINUTES
 from datetime import timedelta
 
+# User documents, shared by all UserManager instances in the process; the short TTL bounds
+# staleness from writers in other processes (scripts), in-process writes invalidate directly
+_user_cache = TTLCache(maxsize=10_000, ttl=10)
+# Exact totals for admin pagination, keyed by criteria; dropped on user insert/delete
+_user_count_cache = TTLCache(maxsize=16, ttl=30)
+NON_ADMIN_CRITERIA = {"role": {"$ne": "admin"}}
+# Users flagged `blocked` (Forbidden on a previous send) are skipped until they /start again
+BROADCAST_CRITERIA = {"status": {"$ne": "banned"}, "blocked": {"$ne": True}}
+FILTER_VIEW_FIELDS = {"_id": 0, "search_urls": 1, "preferred_locations": 1}
+# Admin user card: first LINKS_PREVIEW links plus the total, so long link lists are not transferred
+LINKS_PREVIEW = 15
+FILTER_PREVIEW_FIELDS = {
+    "_id": 0,
+    "preferred_locations": 1,
+    "links_preview": {"$slice": [{"$ifNull": ["$search_urls", []]}, LINKS_PREVIEW]},
+    "links_count": {"$size": {"$ifNull": ["$search_urls", []]}},
+}
+# username, else first_name, else user_id; computed server-side so list pages need no fallback chain
+# ($gt against "" also skips the empty strings upsert_user stores for missing names)
+DISPLAY_LABEL = {"$switch": {
+    "branches": [
+        {"case": {"$gt": ["$username", ""]}, "then": "$username"},
+        {"case": {"$gt": ["$first_name", ""]}, "then": "$first_name"},
+    ],
+    "default": "$user_id",
+}}
+_USER_LIST_FIELDS = {"_id": 0, "user_id": 1, "status": 1, "display_label": DISPLAY_LABEL}
+
+
+def _criteria_key(criteria: Dict[str, Any]) -> str:
+    return repr(sorted(criteria.items()))
+
+
 class UserManager:
     def __init__(self):
         self.db = get_db()
+        self.client = get_client()
+
+    def get_user(self, user_id: str) -> Dict[str, Any]:
+        """Cached user document ({} if unknown); writes through UserManager drop the entry."""
+        u = _user_cache.get(user_id)
+        if u is None:
+            u = self.db.users.find_one({"user_id": user_id}, {"_id": 0}) or {}
+            _user_cache[user_id] = u
+        return u
+
+    def invalidate_user(self, user_id: str):
+        """Drop cached data after writing to the user's document outside UserManager."""
+        _user_cache.pop(user_id, None)
+        _user_count_cache.clear()
+
+    def count_users(self, criteria: Dict[str, Any]) -> int:
+        """count_documents with a short-lived cache (pagination clicks reuse the total)."""
+        key = _criteria_key(criteria)
+        n = _user_count_cache.get(key)
+        if n is None:
+            n = self.db.users.count_documents(criteria)
+            _user_count_cache[key] = n
+        return n
+
+    def get_users_page(self, skip: int, limit: int, criteria: Dict[str, Any] = NON_ADMIN_CRITERIA) -> Tuple[List[Dict[str, Any]], int]:
+        """One page of users (newest first) plus the total matching count (cached, see count_users).
+        The page is a plain find so the sort can walk the date_added index."""
+        docs = list(self.db.users.find(criteria, _USER_LIST_FIELDS).sort("date_added", -1).skip(skip).limit(limit))
+        return docs, self.count_users(criteria)
+
+    def find_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        """Case-insensitive exact username match via the indexed username_lower field."""
+        return self.db.users.find_one({"username_lower": username.lower()})
 
     # Users
-    def upsert_user(self, user_id: str, username: str = "", first_name: str = "", last_name: str = ""):
+    @staticmethod
+    def _new_user_fields(first_name: str = "", last_name: str = "") -> Dict[str, Any]:
+        """Fields of a freshly created user document (used with $setOnInsert; the username is
+        $set on every upsert instead, see upsert_and_get)."""
         now_iso = datetime.utcnow().isoformat()
-        self.db.users.update_one(
-            {"user_id": user_id},
-            {"$setOnInsert": {
-                "username": username,
-                "first_name": first_name,
-                "last_name": last_name,
-                "role": "user",
-                "status": "pending",
-                "subscription_expires": None,
-                "max_notifications_per_day": USER_DAILY_LIMIT,
-                "date_added": now_iso,
-                "date_activated": None,
-                "bot_started_at": now_iso,
-                "language": None,  # Language not set yet, will be set on language selection
-                "notes": ""
-            }},
-            upsert=True
+        return {
+            "first_name": first_name,
+            "last_name": last_name,
+            "role": "user",
+            "status": "pending",
+            "subscription_expires": None,
+            "max_notifications_per_day": USER_DAILY_LIMIT,
+            "date_added": now_iso,
+            "date_activated": None,
+            "bot_started_at": now_iso,
+            "language": None,  # Language not set yet, will be set on language selection
+            "notes": ""
+        }
+
+    def upsert_user(self, user_id: str, username: str = "", first_name: str = "", last_name: str = ""):
+        self.upsert_and_get(user_id, username, first_name, last_name)
+
+    def upsert_and_get(self, user_id: str, username: str = "", first_name: str = "", last_name: str = "") -> Dict[str, Any]:
+        """Create the user if missing and return the current document in a single round-trip
+        (the result also primes the user cache)."""
+        return self._update_and_cache(
+            user_id,
+            {"$setOnInsert": self._new_user_fields(first_name, last_name),
+             # Telegram usernames can change; keep username_lower in step for find_user_by_username
+             "$set": {"username": username, "username_lower": (username or "").lower()},
+             # The user is talking to the bot again, so broadcasts may reach them
+             "$unset": {"blocked": ""}},
+            upsert=True,
         )
     
     def set_user_language(self, user_id: str, language: str):
@@ -37,11 +119,12 @@ class UserManager:
             {"user_id": user_id},
             {"$set": {"language": language}}
         )
+        _user_cache.pop(user_id, None)
     
     def get_user_language(self, user_id: str) -> str:
         """Get the user's preferred language, defaulting to 'uk' (Ukrainian)."""
-        user = self.db.users.find_one({"user_id": user_id})
-        if user and user.get("language"):
+        user = self.get_user(user_id)
+        if user.get("language"):
             return user["language"]
         return "uk"  # Default to Ukrainian
 
@@ -62,31 +145,34 @@ class UserManager:
                 "max_notifications_per_day": USER_DAILY_LIMIT,
             }}
         )
+        _user_cache.pop(user_id, None)
 
-    def mark_trial(self, user_id: str):
+    def mark_trial(self, user_id: str, create: bool = False) -> Dict[str, Any]:
         """Start a free trial period for the user for TRIAL_DURATION (14 days).
         Sets date_activated to now and subscription_expires to now + 14 days.
+        Returns the updated user document ({} if the user does not exist).
+        create=True inserts a minimal user first if needed, in the same atomic call.
         """
         now = datetime.utcnow()
-        self.db.users.update_one(
-            {"user_id": user_id},
-            {"$set": {
-                "status": "active",
-                "date_activated": now.isoformat(),
-                "subscription_expires": (now + TRIAL_DURATION).isoformat(),
-                "awaiting_payment": False,
-            }, "$unset": {
-                "requested_subscription": ""
-            }}
-        )
+        update = {"$set": {
+            "status": "active",
+            "date_activated": now.isoformat(),
+            "subscription_expires": (now + TRIAL_DURATION).isoformat(),
+            "awaiting_payment": False,
+        }, "$unset": {
+            "requested_subscription": ""
+        }}
+        if create:
+            update["$setOnInsert"] = {k: v for k, v in self._new_user_fields().items() if k not in update["$set"]}
+        return self._update_and_cache(user_id, update, upsert=create)
 
-    def mark_paid(self, user_id: str):
+    def mark_paid(self, user_id: str) -> Dict[str, Any]:
         """Start a paid subscription window for the user for SUBSCRIPTION_DURATION.
-        Also sets date_activated to now.
+        Also sets date_activated to now. Returns the updated user document ({} if the user does not exist).
         """
         now = datetime.utcnow()
-        self.db.users.update_one(
-            {"user_id": user_id},
+        return self._update_and_cache(
+            user_id,
             {"$set": {
                 "status": "active",
                 "date_activated": now.isoformat(),
@@ -95,6 +181,55 @@ class UserManager:
             }}
         )
 
+    def cancel_subscriptions(self, user_ids: List[str]) -> int:
+        """Expire the subscriptions of all given users in one bulk write (links are kept).
+        Returns the number of modified user documents.
+        """
+        if not user_ids:
+            return 0
+        now_iso = datetime.utcnow().isoformat()
+        res = self.db.users.bulk_write([
+            UpdateOne(
+                {"user_id": uid},
+                {"$set": {"subscription_expires": now_iso, "status": "inactive", "awaiting_payment": False},
+                 "$unset": {"requested_subscription": ""}},
+            )
+            for uid in user_ids
+        ], ordered=False)
+        for uid in user_ids:
+            _user_cache.pop(uid, None)
+        _user_count_cache.clear()
+        return res.modified_count
+
+    def set_setup_request(self, user_id: str, request: Dict[str, Any]):
+        """Store the user's pending search-setup request."""
+        self.db.users.update_one({"user_id": user_id}, {"$set": {"setup_request": request}})
+        _user_cache.pop(user_id, None)
+
+    def mark_blocked(self, user_ids: List[str]):
+        """Flag users who blocked the bot so later broadcasts skip them."""
+        if not user_ids:
+            return
+        self.db.users.update_many({"user_id": {"$in": user_ids}}, {"$set": {"blocked": True}})
+        for uid in user_ids:
+            _user_cache.pop(uid, None)
+        _user_count_cache.clear()
+
+    def _update_and_cache(self, user_id: str, update: Dict[str, Any], upsert: bool = False) -> Dict[str, Any]:
+        """Apply `update` and return the new document in the same round-trip, refreshing the cache."""
+        doc = self.db.users.find_one_and_update(
+            {"user_id": user_id}, update, projection={"_id": 0}, upsert=upsert, return_document=ReturnDocument.AFTER
+        ) or {}
+        # find_one_and_update does not report an insert; the $setOnInsert timestamp only
+        # shows up in the returned document if this call created it
+        if upsert and doc.get("date_added") == update.get("$setOnInsert", {}).get("date_added"):
+            _user_count_cache.clear()
+        if doc:
+            _user_cache[user_id] = doc
+        else:
+            _user_cache.pop(user_id, None)
+        return doc
+
     def delete_user(self, user_id: str) -> bool:
         """Hard-delete user and related data. Returns True if deleted.
         Protects admin accounts from deletion.
@@ -108,6 +243,8 @@ class UserManager:
         self.db.user_filters.delete_one({"user_id": user_id})
         self.db.notification_stats.delete_many({"recipient_id": user_id})
         res = self.db.users.delete_one({"user_id": user_id})
+        _user_cache.pop(user_id, None)
+        _user_count_cache.clear()
         return res.deleted_count > 0
 
     def get_active_users(self) -> List[Dict[str, Any]]:
@@ -122,13 +259,18 @@ class UserManager:
 
     def get_all_users_for_broadcast(self) -> List[Dict[str, Any]]:
         """Return all users (active, pending, inactive) for admin broadcast.
-        Excludes banned users and returns user_id, username, status.
+        Excludes banned users and users who blocked the bot; returns user_id, username, status.
         """
         return list(self.db.users.find(
-            {"status": {"$ne": "banned"}},
-            {"user_id": 1, "username": 1, "first_name": 1, "status": 1}
+            BROADCAST_CRITERIA,
+            {"_id": 0, "user_id": 1, "username": 1, "first_name": 1, "status": 1}
         ))
 
+    def iter_users_for_broadcast(self) -> Iterator[str]:
+        """Stream user_ids of all non-banned users; the cursor fetches from the server in batches."""
+        cursor = self.db.users.find(BROADCAST_CRITERIA, {"_id": 0, "user_id": 1}).batch_size(500)
+        return (u["user_id"] for u in cursor if u.get("user_id"))
+
     def get_users_started_but_not_activated(self) -> List[Dict[str, Any]]:
         """Return users who started the bot but didn't activate 14-day subscription.
         These are users with bot_started_at set but status is 'pending' and no subscription_expires.
@@ -142,7 +284,7 @@ class UserManager:
                     {"subscription_expires": {"$lt": datetime.utcnow().isoformat()}}
                 ]
             },
-            {"user_id": 1, "username": 1, "first_name": 1, "bot_started_at": 1}
+            {"_id": 0, "user_id": 1, "username": 1, "first_name": 1, "bot_started_at": 1}
         ))
 
     def can_send_notification(self, user_id: str) -> bool:
@@ -158,6 +300,16 @@ class UserManager:
         return count < limit
 
     # Filters
+    @staticmethod
+    def links_assigned_fields(now_iso: str) -> Dict[str, Any]:
+        """user_filters fields reset whenever a user's links are (re)assigned."""
+        return {
+            "cities_assigned_date": now_iso,
+            # next_run_at будет выставлен при первом фактическом запуске (run_for_user)
+            "next_run_at": None,
+            "last_run_at": None,
+        }
+
     def set_user_links(self, user_id: str, search_urls: List[str], preferred_locations: Optional[List[str]] = None, access_mode: Optional[str] = None):
         """Assign links and optional access mode.
         access_mode:
@@ -172,12 +324,10 @@ class UserManager:
 
         set_fields: Dict[str, Any] = {
             "user_id": user_id,
-            "search_urls": search_urls,
+            # Duplicates would only be fetched and parsed twice per run
+            "search_urls": list(dict.fromkeys(search_urls)),
             "preferred_locations": preferred_locations,
-            "cities_assigned_date": now_iso,
-            # next_run_at будет выставлен при первом фактическом запуске (run_for_user)
-            "next_run_at": None,
-            "last_run_at": None,
+            **self.links_assigned_fields(now_iso),
         }
 
         if access_mode in ("trial", "subscription"):
@@ -208,9 +358,12 @@ class UserManager:
             {"$set": set_fields, "$setOnInsert": on_insert},
             upsert=True,
         )
+        # Access state derived from the user document (e.g. the bot's menu) also depends on the trial fields
+        _user_cache.pop(user_id, None)
 
-    def get_user_filters(self, user_id: str) -> Optional[Dict[str, Any]]:
-        return self.db.user_filters.find_one({"user_id": user_id})
+    def get_user_filters(self, user_id: str, fields: Optional[Dict[str, int]] = None) -> Optional[Dict[str, Any]]:
+        """Filters document of a user; pass `fields` as a projection when only a few keys are read."""
+        return self.db.user_filters.find_one({"user_id": user_id}, fields)
 
     def mark_user_run(self, user_id: str):
         now_utc = datetime.utcnow()